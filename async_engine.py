@@ -0,0 +1,519 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+from datetime import datetime
+
+import aioboto3
+from aiobotocore.config import AioConfig
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+
+import metrics
+import update
+from llm_scheduler import AsyncLLMScheduler, SchedulerClosed
+from streaming import StreamBuffer, append_progress, end_progress, start_progress
+from persistence import RESULT_INDEXES, AsyncResultBatch, result_update
+
+logger = logging.getLogger(__name__)
+
+# Studies processed concurrently by one event loop
+ASYNC_MAX_STUDIES = int(os.environ.get('ASYNC_MAX_STUDIES', 20))
+
+
+class AsyncLogQueue(update.LogQueue):
+    """LogQueue whose consumers are coroutines on a single event loop."""
+
+    def __init__(self, debounce, **settings):
+        super().__init__(debounce, **settings)
+        self.event = asyncio.Event()
+
+    def _wake(self):
+        super()._wake()
+        self.event.set()
+
+    async def pop_async(self):
+        while True:
+            log, timeout = self.take()
+            if log is not None:
+                return log
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except TimeoutError:
+                pass
+
+
+class AsyncEngine:
+    """The update.py pipeline as coroutines on motor, aioboto3 and the Gemini async API.
+
+    Only the I/O is reimplemented here; planning and bookkeeping are the
+    engine-independent helpers of update.py. Started with `update.py async`.
+
+    Studies, filters and prompts run as tasks in nested TaskGroups, so
+    cancelling a study cancels everything it started. Setting `stopping`
+    shuts the engine down the way update.main does on SIGTERM.
+    """
+
+    def __init__(self, db, s3):
+        self.db = db
+        self.s3 = s3
+        self.scheduler = AsyncLLMScheduler(**update.SCHEDULER_SETTINGS, dead_letter=self.dead_letter)
+        self.downloads = asyncio.Semaphore(update.DOWNLOAD_WORKERS)
+        self.held_leases = set()
+        # Outputs of each running study still to be indexed in analysis_results
+        self.results = {}
+        self.stopping = asyncio.Event()
+        self.ingest_failed = False
+
+    async def dead_letter(self, job, error):
+        await self.db['llm_dead_letters'].insert_one({**job.meta, 'error': str(error), 'attempts': job.attempts,
+                                                      'failed_at': datetime.now()})
+
+    async def save_object(self, file_obj, path, csv_file):
+        target = f"{path}.part" if csv_file else path
+        with metrics.stage('s3_download', path=path), open(target, 'wb') as f:
+            async for chunk in file_obj["Body"].iter_chunks(update.DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                metrics.s3_bytes.inc(len(chunk))
+        if csv_file:
+            await asyncio.to_thread(update.transcode_csv, target, path)
+
+    async def list_study_files(self, study_id):
+        key = f"surveys/{study_id}/"
+        pages = aiter(self.s3.get_paginator('list_objects_v2').paginate(Bucket=os.environ['BUCKET_NAME'], Prefix=key))
+        while True:
+            with metrics.stage('s3_list', study_id=study_id):
+                page = await anext(pages, None)
+            if page is None:
+                return
+            for item in page.get('Contents', []):
+                if item['Key'] != key:
+                    yield item
+
+    async def stage_object(self, file_key, etag, path, survey=False):
+        staging = update.get_staging()
+        if await asyncio.to_thread(staging.link, file_key, etag, path):
+            return True
+        file_obj = await self.s3.get_object(Bucket=os.environ['BUCKET_NAME'], Key=file_key)
+        if not survey and file_obj["ContentType"] not in ("application/pdf", "text/csv"):
+            file_obj["Body"].close()
+            return False
+        await self.save_object(file_obj, path, survey or file_obj["ContentType"] == "text/csv")
+        await asyncio.to_thread(staging.add, file_key, etag, path)
+        return True
+
+    async def fetch_study_file(self, study_id, item, run_dir):
+        file_key = item['Key']
+        path = os.path.join(run_dir, file_key.split('/')[-1])
+        cache_key = (study_id, file_key, item['ETag'])
+        async with self.downloads:
+            survey = file_key == f"surveys/{study_id}/log_{study_id}.csv"
+            if survey:
+                # Parsed locally for the per-filter subsets, so fetched even when its upload is cached
+                await self.stage_object(file_key, item['ETag'], path, survey=True)
+            handle = update.file_cache.lookup(cache_key)
+            if handle is None:
+                file = None
+                if survey or await self.stage_object(file_key, item['ETag'], path):
+                    with metrics.stage('genai_upload', study_id=study_id, key=file_key):
+                        file = await asyncio.to_thread(update.get_genai().upload_file, path)
+                handle = update.file_cache.add(cache_key, file)
+        if handle.file is None:
+            update.file_cache.release([handle])
+            return None
+        return handle
+
+    async def download_files_from_s3(self, study_id, run_dir):
+        handles = []
+
+        async def fetch(item):
+            handle = await self.fetch_study_file(study_id, item, run_dir)
+            if handle is not None:
+                handles.append(handle)
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                async for item in self.list_study_files(study_id):
+                    tg.create_task(fetch(item))
+        except BaseException:
+            update.file_cache.release(handles)
+            raise
+        return sorted(handles, key=lambda handle: handle.key[1])
+
+    async def upload_part(self, stream, path, upload_id):
+        part_number = stream.next_part_number()
+        result = await self.s3.upload_part(Bucket=os.environ['BUCKET_NAME'], Key=path, UploadId=upload_id,
+                                           PartNumber=part_number, Body=stream.take_part())
+        stream.add_part(result['ETag'])
+
+    async def stream_prompt(self, prompt_model, contents, path, meta):
+        progress = self.db['analysis_progress']
+        await progress.update_one({'_id': path}, start_progress(meta, datetime.now()), upsert=True)
+        stream = StreamBuffer(update.STREAM_PART_SIZE, update.STREAM_PROGRESS_SECONDS)
+        upload_id = None
+        try:
+            response = await prompt_model.generate_content_async(contents, stream=True)
+            async for chunk in response:
+                stream.add(chunk.text)
+                if stream.full_part():
+                    if upload_id is None:
+                        upload_id = (await self.s3.create_multipart_upload(Bucket=os.environ['BUCKET_NAME'],
+                                                                           Key=path))['UploadId']
+                    await self.upload_part(stream, path, upload_id)
+                delta = stream.take_delta()
+                if delta:
+                    await progress.update_one({'_id': path}, append_progress(delta, datetime.now()))
+            if upload_id is None:
+                etag = (await self.s3.put_object(Bucket=os.environ['BUCKET_NAME'], Key=path,
+                                                 Body=stream.take_part()))['ETag']
+            else:
+                if stream.buffer:
+                    await self.upload_part(stream, path, upload_id)
+                etag = (await self.s3.complete_multipart_upload(Bucket=os.environ['BUCKET_NAME'], Key=path,
+                                                                UploadId=upload_id,
+                                                                MultipartUpload={'Parts': stream.parts}))['ETag']
+            delta = stream.take_delta(force=True)
+            if delta:
+                await progress.update_one({'_id': path}, append_progress(delta, datetime.now()))
+            await progress.update_one({'_id': path}, end_progress('done', datetime.now()))
+            return response, etag
+        except BaseException:
+            # Shielded so a cancelled study still cleans up its upload
+            if upload_id is not None:
+                await asyncio.shield(self.s3.abort_multipart_upload(Bucket=os.environ['BUCKET_NAME'], Key=path,
+                                                                    UploadId=upload_id))
+            await asyncio.shield(progress.update_one({'_id': path}, end_progress('failed', datetime.now())))
+            raise
+
+    async def save_result(self, meta, path, input_hash, md_response, request, response, seconds):
+        with metrics.stage('s3_put', {'analysis': meta['analysis']}, path=path):
+            etag = (await self.s3.put_object(Bucket=os.environ['BUCKET_NAME'], Key=path, Body=md_response))['ETag']
+        await self.results[meta['study_id']].add(result_update(meta['study_id'], meta['filter'], meta['analysis'], path,
+                                                               etag, request, response, seconds, input_hash))
+
+    async def process_prompt(self, context, prompt, files, path, input_hash, meta, timing):
+        prompt_model, contents = await asyncio.to_thread(context.prepare, files, prompt)
+        started = time.perf_counter()
+        if update.STREAM_GENERATION:
+            with metrics.stage('generate', {'analysis': meta['analysis']}, study_id=meta['study_id'], filter=meta['filter']):
+                response, etag = await self.stream_prompt(prompt_model, contents, path, meta)
+            metrics.record_usage(response, meta['analysis'])
+            await self.results[meta['study_id']].add(result_update(meta['study_id'], meta['filter'], meta['analysis'],
+                                                                   path, etag, meta['analysis'], response,
+                                                                   time.perf_counter() - started, input_hash))
+        else:
+            with metrics.stage('generate', {'analysis': meta['analysis']}, study_id=meta['study_id'], filter=meta['filter']):
+                response = await prompt_model.generate_content_async(contents)
+            metrics.record_usage(response, meta['analysis'])
+        timing['seconds'] = time.perf_counter() - started
+        return response
+
+    async def process_group(self, context, group_prompt, keys, files, meta, timing):
+        prompt_model, contents = await asyncio.to_thread(context.prepare, files, group_prompt)
+        started = time.perf_counter()
+        with metrics.stage('generate', {'analysis': '+'.join(keys)}, study_id=meta['study_id'], filter=meta['filter']):
+            response = await prompt_model.generate_content_async(contents)
+        metrics.record_usage(response, '+'.join(keys))
+        timing['seconds'] = time.perf_counter() - started
+        return response
+
+    async def run_prompt(self, context, key, prompt, files, paths, hashes, priority, meta, failed):
+        # Outputs are written once the scheduler has released the model slot
+        meta = {**meta, 'analysis': key}
+        timing = {}
+        try:
+            response = await self.scheduler.run(self.process_prompt, context, prompt, files, paths[key], hashes[key],
+                                                meta, timing, priority=priority, meta=meta, group=meta['study_id'])
+            if not update.STREAM_GENERATION:
+                await self.save_result(meta, paths[key], hashes[key], response.text, key, response, timing['seconds'])
+        except SchedulerClosed:
+            # Not sent before shutdown
+            failed.append(key)
+        except Exception as e:
+            logger.error(f"Error retrieving result for {key}: {e}")
+            failed.append(key)
+
+    async def run_group(self, tg, context, keys, prompts, files, paths, hashes, priority, meta, failed):
+        request = '+'.join(keys)
+        timing = {}
+        try:
+            response = await self.scheduler.run(self.process_group, context, update.build_group_prompt(prompts, keys), keys,
+                                                files, meta, timing, priority=priority, group=meta['study_id'],
+                                                meta={**meta, 'analysis': request})
+            sections = update.split_sections(response.text, keys)
+        except SchedulerClosed:
+            failed.extend(keys)
+            return
+        except Exception as e:
+            logger.error(f"Error retrieving result for {request}: {e}")
+            sections = {}
+        for key, md_response in sections.items():
+            try:
+                await self.save_result({**meta, 'analysis': key}, paths[key], hashes[key], md_response, request, response,
+                                       timing['seconds'])
+            except Exception as e:
+                logger.error(f"Error saving result for {key}: {e}")
+                failed.append(key)
+        # Sections the grouped response failed or garbled are asked for one by one
+        for key in keys:
+            if key not in sections:
+                tg.create_task(self.run_prompt(context, key, prompts[key], files, paths, hashes, priority, meta, failed))
+
+    async def perform_analysis(self, study_id, filter, files, etags, context):
+        prompts, paths, hashes = update.analysis_plan(study_id, filter, files, etags, context.preamble)
+        if update.RESULT_CACHE:
+            docs = await self.db['analysis_results'].find({'_id': {'$in': list(paths.values())}},
+                                                          {'input_hash': 1}).to_list(None)
+            prompts = update.pending_prompts(prompts, paths, hashes, {doc['_id']: doc.get('input_hash') for doc in docs})
+        priority = update.filter_priority(filter)
+        meta = {'study_id': study_id, 'filter': filter}
+        groups, singles = update.plan_groups(prompts)
+        failed = []
+        async with asyncio.TaskGroup() as tg:
+            for key in singles:
+                tg.create_task(self.run_prompt(context, key, prompts[key], files, paths, hashes, priority, meta, failed))
+            for keys in groups:
+                tg.create_task(self.run_group(tg, context, keys, prompts, files, paths, hashes, priority, meta, failed))
+        return failed
+
+    async def run_analysis(self, completed, study_id, filter, *args):
+        try:
+            with metrics.stage('filter', study_id=study_id, filter=filter):
+                if not await self.perform_analysis(study_id, filter, *args):
+                    completed.append(filter)
+        except Exception as e:
+            logger.error(f"Error processing analysis: {e}")
+
+    async def analyze_study(self, study_id, filters, preamble, handles, survey_data):
+        completed = []
+        self.results[study_id] = AsyncResultBatch(study_id, self.db['analysis_results'], update.RESULT_FLUSH_SIZE,
+                                                  update.RESULT_FLUSH_SECONDS)
+        try:
+            context = await asyncio.to_thread(update.study_context, preamble)
+            uploads = []
+            try:
+                incremental = update.INCREMENTAL_ANALYSIS and survey_data is not None
+                pending = filters
+                if incremental:
+                    manifest = await self.db['analysis_manifests'].find_one({'_id': ObjectId(study_id)})
+                    pending, shared, digests = await asyncio.to_thread(update.plan_filters, study_id, filters, preamble,
+                                                                       handles, survey_data, manifest)
+                inputs = await asyncio.to_thread(list, update.filter_inputs(study_id, handles, survey_data, pending,
+                                                                           uploads))
+                async with asyncio.TaskGroup() as tg:
+                    for filter, files, etags in inputs:
+                        tg.create_task(self.run_analysis(completed, study_id, filter, files, etags, context))
+            finally:
+                await asyncio.shield(asyncio.to_thread(context.close))
+                update.file_cache.release(uploads)
+        finally:
+            # Unindexed outputs are regenerated, so a failed write fails the study and its log is retried
+            await asyncio.shield(self.results.pop(study_id).flush())
+        if incremental:
+            # Filters with failed analyses keep their old entry, so the next run retries them
+            await self.db['analysis_manifests'].update_one(
+                {'_id': ObjectId(study_id)},
+                update.manifest_update(manifest, shared, digests, completed, len(survey_data)), upsert=True)
+        return pending, completed
+
+    async def process_log(self, log):
+        study_id = str(log['_id'])
+        last_updated = log['last_update']
+        # Get filters from Surveys collection
+        try:
+            with metrics.stage('mongo_lookup', {'collection': 'Surveys'}, study_id=study_id):
+                survey = await self.db['Surveys'].find_one({'_id': ObjectId(study_id)})
+        except PyMongoError:
+            survey = None
+        # Get study details from Study collection
+        with metrics.stage('mongo_lookup', {'collection': 'Study'}, study_id=study_id):
+            study = await self.db['Study'].find_one({'_id': ObjectId(study_id)})
+        filters, preamble = update.study_inputs(study_id, survey, study)
+        # Local copies stay until the study ends: filters read their rows back from the survey file
+        with update.get_staging().run(study_id) as run_dir:
+            handles = await self.download_files_from_s3(study_id, run_dir)
+            survey_data = None
+            try:
+                survey_data = await asyncio.to_thread(update.load_survey, study_id, run_dir)
+                pending, completed = await self.analyze_study(study_id, filters, preamble, handles, survey_data)
+            finally:
+                # Uploaded files stay cached for later runs until evicted
+                update.file_cache.release(handles)
+                if survey_data is not None:
+                    survey_data.close()
+        update.finish_study(study_id, filters, pending, completed, self.stopping.is_set())
+        await self.db['survey_logs'].delete_one({'_id': ObjectId(study_id), 'last_update': last_updated,
+                                                 'lease_owner': update.WORKER_ID})
+
+    async def claim_log(self, log):
+        claimed = await self.db['survey_logs'].find_one_and_update(*update.lease_claim(log['_id']),
+                                                                   return_document=ReturnDocument.AFTER)
+        if claimed is not None:
+            self.held_leases.add(claimed['_id'])
+        return claimed
+
+    async def release_log(self, log):
+        self.held_leases.discard(log['_id'])
+        await self.db['survey_logs'].update_one(*update.lease_release([log['_id']]))
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(update.LEASE_SECONDS / 3)
+            if not self.held_leases:
+                continue
+            try:
+                await self.db['survey_logs'].update_many(*update.lease_renewal(list(self.held_leases)))
+            except PyMongoError as e:
+                logger.error(f"Error renewing leases: {e}")
+
+    async def worker(self, log_queue):
+        while True:
+            log = await log_queue.pop_async()
+            if self.stopping.is_set():
+                log_queue.done(log)
+                return
+            try:
+                claimed = await self.claim_log(log)
+                if claimed is None:
+                    holder = await self.db['survey_logs'].find_one({'_id': log['_id']}, {'lease_expires': 1})
+                    if holder is not None:
+                        log_queue.retry(log, update.lease_retry_delay(holder))
+                    continue
+                try:
+                    with metrics.stage('study', study_id=str(claimed['_id'])):
+                        await self.process_log(claimed)
+                finally:
+                    await asyncio.shield(self.release_log(claimed))
+            except Exception as e:
+                logger.error(f"An error occurred during parallel processing: {e}")
+                log_queue.retry(log, update.LOG_DEBOUNCE_SECONDS)
+            finally:
+                log_queue.done(log)
+
+    async def estimate_work(self, study_id):
+        survey = await self.db['Surveys'].find_one({'_id': ObjectId(study_id)}, {'filters': 1}) or {}
+        total_bytes = 0
+        async for item in self.list_study_files(study_id):
+            total_bytes += item['Size']
+        return update.study_work(len(survey.get('filters') or []), total_bytes)
+
+    async def enqueue(self, log_queue, log):
+        work = None
+        if log_queue.needs_work(log):
+            try:
+                work = await self.estimate_work(str(log['_id']))
+            except Exception as e:
+                logger.warning(f"Could not estimate the size of study {log['_id']}: {e}")
+        return log_queue.push(log, work)
+
+    async def scan_logs(self, log_queue):
+        new_logs = 0
+        async for log in self.db['survey_logs'].find({}, {'last_update': 1, 'priority': 1}):
+            if await self.enqueue(log_queue, log):
+                new_logs += 1
+        return new_logs
+
+    async def watch_logs(self, log_queue):
+        resume_token = None
+        while True:
+            try:
+                async with self.db['survey_logs'].watch(update.LOG_EVENTS_PIPELINE, full_document='updateLookup',
+                                                        resume_after=resume_token) as stream:
+                    if resume_token is None:
+                        # Logs written before the stream was opened
+                        await self.scan_logs(log_queue)
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        log = change.get('fullDocument')
+                        if log is not None and 'last_update' in log:
+                            await self.enqueue(log_queue, log)
+            except OperationFailure as e:
+                if update.stream_unsupported(e):
+                    return False
+                resume_token = None
+                await asyncio.sleep(update.POLL_MIN_INTERVAL)
+            except PyMongoError as e:
+                logger.warning(f"Change stream interrupted: {e}")
+                await asyncio.sleep(update.POLL_MIN_INTERVAL)
+
+    async def poll_logs(self, log_queue):
+        interval = update.POLL_MIN_INTERVAL
+        while True:
+            try:
+                new_logs = await self.scan_logs(log_queue)
+            except PyMongoError as e:
+                logger.error(f"Error polling survey_logs: {e}")
+                new_logs = 0
+            interval = update.next_poll_interval(interval, new_logs)
+            await asyncio.sleep(interval)
+
+    async def ingest(self, log_queue):
+        try:
+            if update.INGEST_MODE == 'poll' or not await self.watch_logs(log_queue):
+                await self.poll_logs(log_queue)
+        except Exception as e:
+            # Shut down through drain like the daemon, so uploads are still cleared
+            logger.error(f"Ingestion stopped: {e}")
+            self.ingest_failed = True
+            self.stopping.set()
+
+    async def sweep_file_cache(self):
+        while True:
+            await asyncio.sleep(update.FILE_CACHE_SWEEP_SECONDS)
+            await asyncio.to_thread(update.file_cache.evict)
+            try:
+                await asyncio.to_thread(update.get_staging().sweep)
+            except OSError as e:
+                logger.error(f"Error sweeping the staging area: {e}")
+
+    async def run(self):
+        update.get_prompts()
+        await self.db['analysis_results'].create_indexes(RESULT_INDEXES)
+        log_queue = AsyncLogQueue(update.LOG_DEBOUNCE_SECONDS, **update.QUEUE_SETTINGS)
+        metrics.gauge('study_queue_depth', 'Studies logged and waiting to be processed', log_queue.depth)
+        metrics.gauge('llm_queue_depth', 'Model requests waiting for an in-flight slot', self.scheduler.depth)
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(self.sweep_file_cache()), tg.create_task(self.heartbeat()),
+                     *[tg.create_task(self.worker(log_queue)) for _ in range(ASYNC_MAX_STUDIES)],
+                     tg.create_task(self.ingest(log_queue))]
+            tg.create_task(self.drain(tasks))
+        # Uploads only live in this process's cache
+        await asyncio.to_thread(update.file_cache.clear)
+        return 1 if self.ingest_failed else 0
+
+    async def drain(self, tasks):
+        """Once stopping, let studies in progress finish their running prompts, then cancel them."""
+        await self.stopping.wait()
+        abandoned = self.scheduler.close()
+        logger.info("Shutting down", extra={'fields': {'abandoned_prompts': abandoned,
+                                                       'grace_seconds': update.SHUTDOWN_GRACE_SECONDS}})
+        deadline = time.monotonic() + update.SHUTDOWN_GRACE_SECONDS
+        while self.held_leases and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.held_leases:
+            logger.warning(f"Releasing {len(self.held_leases)} studies still in progress after "
+                           f"{update.SHUTDOWN_GRACE_SECONDS}s")
+        # Cancelled studies clean up and release their leases on the way out
+        for task in tasks:
+            task.cancel()
+
+
+async def main():
+    update.setup_observability()
+    client = AsyncIOMotorClient(os.environ['MONGO_URI'])
+    session = aioboto3.Session(aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                               aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+    config = AioConfig(max_pool_connections=update.S3_MAX_POOL_CONNECTIONS,
+                       retries={'max_attempts': update.S3_MAX_ATTEMPTS, 'mode': 'standard'})
+    async with session.client('s3', region_name='us-east-1', config=config) as s3:
+        engine = AsyncEngine(client['cheetah_research'], s3)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(signum, engine.stopping.set)
+        return await engine.run()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,380 @@
+"""Offline throughput benchmark for the update.py pipeline.
+
+Runs the real `main` loop (polling ingestion, leases, workers, scheduler,
+process_log and perform_analysis) against local stand-ins: mongomock (or a
+throwaway local mongod through --mongo-uri), moto for S3 and a stub Gemini
+with configurable latency, error rate and 429 quota. For every workload in
+filters x file sizes x study count it reports studies/minute, p50/p99 study
+latency (survey_logs insert to processed), peak threads and peak RSS.
+
+--nodes runs that many copies of the pipeline side by side, each with its own
+WORKER_ID, leases, queue, caches and staging directory, against the same
+database, the way separate worker nodes would. Every log must be processed by
+exactly one of them: the run exits with status 1 if a study was processed
+twice.
+
+Needs mongomock and moto besides the pipeline's own dependencies:
+
+    python benchmarks/bench.py --filters 1,4 --file-kb 64,1024 --studies 5,20
+
+Pipeline settings (WORKERS, LLM_MAX_IN_FLIGHT, LLM_MAX_RETRIES, ...) are read
+from the environment as usual.
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = 'cr-analyzer-bench'
+SECTION = re.compile(r'<<<SECCION:\s*(\w+)\s*>>>')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--filters', default='1,4', help="filters per study besides General")
+    parser.add_argument('--file-kb', default='64,1024', help="size of the survey CSV and of the study PDF")
+    parser.add_argument('--studies', default='5', help="studies logged at once per workload")
+    parser.add_argument('--latency', type=float, default=0.2, help="mean seconds per generate_content call")
+    parser.add_argument('--jitter', type=float, default=0.5, help="latency spread, as a fraction of --latency")
+    parser.add_argument('--upload-latency', type=float, default=0.05, help="seconds per genai.upload_file call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls failing with a 500")
+    parser.add_argument('--quota-rpm', type=int, default=0, help="calls per minute before the stub answers 429")
+    parser.add_argument('--response-kb', type=float, default=4, help="size of each generated analysis")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds before a workload is abandoned")
+    parser.add_argument('--nodes', type=int, default=2, help="worker nodes sharing the database")
+    parser.add_argument('--mongo-uri', help="use this mongod instead of mongomock (its cheetah_research db is written)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    return parser.parse_args()
+
+
+class Usage:
+    def __init__(self, prompt_tokens, candidate_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = candidate_tokens
+        self.cached_content_token_count = 0
+        self.total_token_count = prompt_tokens + candidate_tokens
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class Response:
+    def __init__(self, text, usage):
+        self.text = text
+        self.usage_metadata = usage
+
+    def __iter__(self):
+        # Streamed responses arrive in a handful of chunks
+        step = max(1, len(self.text) // 8)
+        for start in range(0, len(self.text), step):
+            yield Chunk(self.text[start:start + step])
+
+
+class StubGemini:
+    """Stand-in for the Gemini API, shared by every model instance."""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.window = deque()
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.uploads = 0
+        self.caches = 0
+
+    def _admit(self):
+        from google.api_core import exceptions
+        with self.lock:
+            self.calls += 1
+            now = time.monotonic()
+            while self.window and now - self.window[0] > 60:
+                self.window.popleft()
+            if self.args.quota_rpm and len(self.window) >= self.args.quota_rpm:
+                self.throttled += 1
+                raise exceptions.ResourceExhausted("Resource has been exhausted (e.g. check quota).")
+            self.window.append(now)
+            failed = self.random.random() < self.args.error_rate
+            delay = self.args.latency * (1 + self.args.jitter * (2 * self.random.random() - 1))
+            if failed:
+                self.errors += 1
+        time.sleep(max(0.0, delay))
+        if failed:
+            raise exceptions.InternalServerError("An internal error has occurred.")
+
+    def generate(self, contents):
+        self._admit()
+        prompt = next((part for part in reversed(contents) if isinstance(part, str)), '')
+        body = "Lorem ipsum dolor sit amet. " * max(1, int(self.args.response_kb * 1024 / 28))
+        sections = SECTION.findall(prompt)
+        if sections:
+            text = "\n".join(f"<<<SECCION: {key}>>>\n# {key}\n{body}" for key in sections)
+        else:
+            text = f"# Análisis\n{body}"
+        prompt_tokens = sum(len(part) if isinstance(part, str) else 1000 for part in contents) // 4
+        return Response(text, Usage(prompt_tokens, len(text) // 4))
+
+    def install(self):
+        import google.generativeai as genai
+        from google.generativeai import caching
+        stub = self
+
+        class File:
+            def __init__(self, path):
+                self.name = f"files/{os.path.basename(path)}-{time.monotonic_ns()}"
+                self.display_name = path
+
+            def delete(self):
+                pass
+
+        class Model:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            @classmethod
+            def from_cached_content(cls, cached_content, generation_config=None):
+                return cls()
+
+            def generate_content(self, contents, stream=False, **kwargs):
+                return stub.generate(contents)
+
+        class CachedContent:
+            def __init__(self):
+                self.name = f"cachedContents/{time.monotonic_ns()}"
+
+            @classmethod
+            def create(cls, **kwargs):
+                with stub.lock:
+                    stub.caches += 1
+                return cls()
+
+            def update(self, **kwargs):
+                pass
+
+            def delete(self):
+                pass
+
+        def upload_file(path, **kwargs):
+            with stub.lock:
+                stub.uploads += 1
+            time.sleep(stub.args.upload_latency)
+            return File(path)
+
+        genai.configure = lambda **kwargs: None
+        genai.upload_file = upload_file
+        genai.GenerativeModel = Model
+        caching.CachedContent = CachedContent
+
+
+class Sampler:
+    """Peak thread count and resident memory, sampled in the background."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.reset()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def reset(self):
+        self.threads = threading.active_count()
+        self.rss = rss_bytes()
+
+    def _run(self):
+        while True:
+            self.threads = max(self.threads, threading.active_count())
+            self.rss = max(self.rss, rss_bytes())
+            time.sleep(self.interval)
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Lifetime peak where /proc is unavailable (ru_maxrss is KiB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def survey_csv(filters, size):
+    rows = ["id,Segmento,Genero,Comentario"]
+    comment = "Me gusta el producto pero el precio es alto"
+    i = 0
+    while sum(len(row) + 1 for row in rows) < size or i < 2 * max(filters, 1):
+        rows.append(f"{i},S{i % max(filters, 1)},{'Femenino' if i % 2 else 'Masculino'},{comment} {i}")
+        i += 1
+    return ("\n".join(rows) + "\n").encode('utf-8')
+
+
+def seed_study(update, ObjectId, filters, size):
+    study_id = ObjectId()
+    key = f"surveys/{study_id}/"
+    s3 = update.get_s3()
+    s3.put_object(Bucket=BUCKET, Key=f"{key}log_{study_id}.csv", Body=survey_csv(filters, size), ContentType='text/csv')
+    s3.put_object(Bucket=BUCKET, Key=f"{key}estudio.pdf", Body=b"%PDF-1.4\n" + os.urandom(size),
+                  ContentType='application/pdf')
+    db = update.get_db()
+    db['Surveys'].insert_one({'_id': study_id, 'prompt': "Estudio sintético de benchmark",
+                              'filters': [f"Segmento: S{i}" for i in range(filters)]})
+    db['Study'].insert_one({'_id': study_id, 'title': "Benchmark", 'studyObjectives': "Medir rendimiento",
+                            'marketTarget': "Adultos"})
+    return study_id
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def counter_total(counter):
+    with counter.lock:
+        return sum(counter.values.values())
+
+
+def run_workload(update, metrics, ObjectId, stub, sampler, runs, filters, file_kb, studies, timeout):
+    ids = [seed_study(update, ObjectId, filters, int(file_kb * 1024)) for _ in range(studies)]
+    calls, errors, throttled = stub.calls, stub.errors, stub.throttled
+    retries, dead = counter_total(metrics.llm_retries), counter_total(metrics.llm_dead_letters)
+    sampler.reset()
+    inserted = {}
+    for study_id in ids:
+        inserted[str(study_id)] = time.monotonic()
+        update.get_db()['survey_logs'].insert_one({'_id': study_id, 'last_update': datetime.now()})
+    start = min(inserted.values())
+    deadline = start + timeout
+    while update.get_db()['survey_logs'].count_documents({'_id': {'$in': ids}}) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - start
+    finished = {study_id: runs[study_id] for study_id in inserted if runs.get(study_id)}
+    latencies = [max(end for _, end, _ in finished[study_id]) - inserted[study_id] for study_id in finished]
+    return {
+        'filters': filters, 'file_kb': file_kb, 'studies': studies,
+        'completed': len(finished),
+        'studies_per_minute': len(finished) / elapsed * 60 if elapsed else 0.0,
+        'p50_seconds': percentile(latencies, 0.5),
+        'p99_seconds': percentile(latencies, 0.99),
+        'peak_threads': sampler.threads,
+        'peak_rss_mb': sampler.rss / 2 ** 20,
+        'model_calls': stub.calls - calls,
+        'errors_500': stub.errors - errors,
+        'errors_429': stub.throttled - throttled,
+        'retries': counter_total(metrics.llm_retries) - retries,
+        'dead_letters': counter_total(metrics.llm_dead_letters) - dead,
+        # Exactly-once check: a study whose single log was processed more than once, by any nodes
+        'duplicates': sum(1 for study_id in finished if len(finished[study_id]) > 1),
+        'nodes_used': len({node for study_id in finished for _, _, node in finished[study_id]}),
+    }
+
+
+def load_node(index):
+    """A separate copy of the update module, standing in for another worker node."""
+    os.environ['WORKER_ID'] = f"bench-node-{index}"
+    os.environ['STAGING_DIR'] = os.path.abspath(f"storage-{index}")
+    if index == 0:
+        import update
+        return update
+    spec = importlib.util.spec_from_file_location(f"update_node{index}", sys.modules['update'].__file__)
+    node = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(node)
+    return node
+
+
+def main():
+    args = parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    os.chdir(tempfile.mkdtemp(prefix='cr-analyzer-bench-'))
+    os.environ.update(AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench', GEMINI_API_KEY='bench',
+                      BUCKET_NAME=BUCKET, MONGO_URI=args.mongo_uri or 'mongodb://localhost:27017')
+    # Logs are processed as soon as they are seen, and idle polling never backs off
+    for name, value in (('LOG_DEBOUNCE_SECONDS', '0'), ('POLL_MAX_INTERVAL', '0.5'),
+                        ('INGEST_MODE', 'auto' if args.mongo_uri else 'poll'),
+                        ('METRICS_PORT', '0'), ('LOG_LEVEL', 'WARNING')):
+        os.environ.setdefault(name, value)
+
+    from moto import mock_aws
+    mock_aws().start()
+    if not args.mongo_uri:
+        import mongomock
+        import mongomock.collection
+        import pymongo
+        # Every node must see the same collections, which separate mongomock clients do not share
+        client = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *args, **kwargs: client
+        # pymongo >= 4.9 passes a `sort` to bulk updates that mongomock does not take
+        add_update = mongomock.collection.BulkOperationBuilder.add_update
+        mongomock.collection.BulkOperationBuilder.add_update = \
+            lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+    stub = StubGemini(args)
+    stub.install()
+
+    import metrics
+    from bson.objectid import ObjectId
+
+    nodes = [load_node(index) for index in range(max(1, args.nodes))]
+    update = nodes[0]
+    update.get_s3().create_bucket(Bucket=BUCKET)
+    runs = {}
+    runs_lock = threading.Lock()
+
+    def timed(node, index):
+        process_log = node.process_log
+
+        def timed_process_log(log):
+            started = time.monotonic()
+            process_log(log)
+            with runs_lock:
+                runs.setdefault(str(log['_id']), []).append((started, time.monotonic(), index))
+
+        return timed_process_log
+
+    sampler = Sampler()
+    for index, node in enumerate(nodes):
+        node.process_log = timed(node, index)
+        threading.Thread(target=node.main, daemon=True).start()
+
+    results = []
+    header = (f"{'filters':>7} {'file_kb':>8} {'studies':>7} {'done':>5} {'st/min':>8} {'p50 s':>8} {'p99 s':>8} "
+              f"{'threads':>7} {'rss MB':>8} {'calls':>6} {'500':>4} {'429':>4} {'retry':>5} {'dead':>4} {'nodes':>5} "
+              f"{'dup':>3}")
+    print(header)
+    for filters, file_kb, studies in itertools.product([int(v) for v in args.filters.split(',')],
+                                                        [float(v) for v in args.file_kb.split(',')],
+                                                        [int(v) for v in args.studies.split(',')]):
+        result = run_workload(update, metrics, ObjectId, stub, sampler, runs, filters, file_kb, studies, args.timeout)
+        results.append(result)
+        print(f"{filters:>7} {file_kb:>8g} {studies:>7} {result['completed']:>5} {result['studies_per_minute']:>8.2f} "
+              f"{result['p50_seconds']:>8.2f} {result['p99_seconds']:>8.2f} {result['peak_threads']:>7} "
+              f"{result['peak_rss_mb']:>8.1f} {result['model_calls']:>6} {result['errors_500']:>4} "
+              f"{result['errors_429']:>4} {result['retries']:>5} {result['dead_letters']:>4} {result['nodes_used']:>5} "
+              f"{result['duplicates']:>3}",
+              flush=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+    duplicates = sum(result['duplicates'] for result in results)
+    if duplicates:
+        print(f"Exactly-once check failed: {duplicates} studies were processed more than once", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
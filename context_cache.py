@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import google.generativeai as genai
+from google.generativeai import caching
+
+logger = logging.getLogger(__name__)
+
+
+class StudyContext:
+    """Gemini cached contents shared by every prompt of one study run.
+
+    The study preamble becomes the system instruction and the uploaded files
+    the cached contents. A cache is created on first use for each distinct
+    set of uploaded files (filters resolved locally leave the survey upload
+    out), renewed while the study runs and deleted by `close`. When caching
+    is disabled or rejected (the content is below the provider's minimum
+    size, or the model version does not support it) prompts are sent whole.
+    """
+
+    def __init__(self, model, cache_model_name, generation_config, preamble, ttl, enabled):
+        self.model = model
+        self.cache_model_name = cache_model_name
+        self.generation_config = generation_config
+        self.preamble = preamble
+        self.ttl = ttl
+        self.enabled = enabled
+        self.caches = {}
+        self.renewed = {}
+        self.lock = threading.Lock()
+
+    def _cached_model(self, uploads):
+        key = tuple(file.name for file in uploads)
+        with self.lock:
+            if key not in self.caches:
+                try:
+                    cache = caching.CachedContent.create(model=self.cache_model_name, system_instruction=self.preamble,
+                                                         contents=list(uploads), ttl=timedelta(seconds=self.ttl))
+                    self.caches[key] = (cache, genai.GenerativeModel.from_cached_content(
+                        cached_content=cache, generation_config=self.generation_config))
+                    self.renewed[key] = time.monotonic()
+                except Exception as e:
+                    logger.warning(f"Context cache unavailable, sending full prompts: {e}")
+                    self.caches[key] = None
+            entry = self.caches[key]
+            if entry is not None and time.monotonic() - self.renewed[key] > self.ttl / 2:
+                entry[0].update(ttl=timedelta(seconds=self.ttl))
+                self.renewed[key] = time.monotonic()
+        return entry[1] if entry is not None else None
+
+    def prepare(self, parts, prompt):
+        """Model and contents to send `prompt` with the given file and text parts."""
+        uploads = [part for part in parts if not isinstance(part, str)]
+        if self.enabled and uploads:
+            cached_model = self._cached_model(uploads)
+            if cached_model is not None:
+                return cached_model, [part for part in parts if isinstance(part, str)] + [prompt]
+        return self.model, parts + [self.preamble + prompt]
+
+    def close(self):
+        with self.lock:
+            entries = [entry for entry in self.caches.values() if entry is not None]
+            self.caches = {}
+        for cache, _ in entries:
+            try:
+                cache.delete()
+            except Exception as e:
+                logger.error(f"Error deleting context cache {cache.name}: {e}")
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Entry:
+    def __init__(self, key, file):
+        self.key = key
+        self.file = file
+        self.refs = 1
+        self.uploaded = time.monotonic()
+        self.last_used = self.uploaded
+        self.stale = False
+
+
+class FileCache:
+    """Reference-counted cache of files uploaded to Gemini.
+
+    Entries are keyed by (study_id, s3_key, etag), so a file is uploaded once
+    and shared by every filter of a study, and reused by later runs while its
+    S3 content is unchanged. Unreferenced entries are deleted by `evict` once
+    they have been idle for `ttl` seconds, are older than `max_age` (Gemini
+    drops uploads after 48 hours), or have been superseded by a new ETag.
+    """
+
+    def __init__(self, ttl, max_age):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.entries = {}
+        self.retired = []
+        self.lock = threading.Lock()
+
+    def _usable(self, entry, now):
+        return not entry.stale and now - entry.uploaded < self.max_age
+
+    def _retire(self, key):
+        entry = self.entries.pop(key)
+        entry.stale = True
+        self.retired.append(entry)
+
+    def lookup(self, key):
+        """Referenced entry for `key`, or None if it has to be uploaded."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._usable(entry, now):
+                entry.refs += 1
+                entry.last_used = now
+                return entry
+        return None
+
+    def add(self, key, file):
+        entry = Entry(key, file)
+        with self.lock:
+            # Older uploads of the same S3 object stay alive until released
+            for other_key in [k for k in self.entries if k[:2] == key[:2]]:
+                self._retire(other_key)
+            self.entries[key] = entry
+        return entry
+
+    def acquire(self, key, upload):
+        """Return a referenced entry for `key`, calling `upload()` on a miss."""
+        entry = self.lookup(key)
+        if entry is None:
+            entry = self.add(key, upload())
+        return entry
+
+    def release(self, entries):
+        now = time.monotonic()
+        with self.lock:
+            for entry in entries:
+                entry.refs -= 1
+                entry.last_used = now
+
+    def clear(self):
+        """Retire every entry and delete the uploads no run still holds."""
+        with self.lock:
+            for key in list(self.entries):
+                self._retire(key)
+        return self.evict()
+
+    def evict(self):
+        now = time.monotonic()
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if not self._usable(e, now)]:
+                self._retire(key)
+            for key in [k for k, e in self.entries.items() if e.refs == 0 and now - e.last_used >= self.ttl]:
+                self._retire(key)
+            files = [entry.file for entry in self.retired if entry.refs <= 0 and entry.file is not None]
+            self.retired = [entry for entry in self.retired if entry.refs > 0]
+        for file in files:
+            try:
+                file.delete()
+            except Exception as e:
+                logger.error(f"Error deleting uploaded file {file.name}: {e}")
+        return len(files)
@@ -0,0 +1,331 @@
+import asyncio
+import heapq
+import inspect
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket refilled continuously at `per_minute` units per minute.
+
+    A limit of 0 disables the bucket. The balance may go negative when usage
+    is only known after the fact (token counts), which delays later callers.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def reserve(self, amount=1):
+        """Take `amount` if available and return 0, else the seconds to wait."""
+        if self.per_minute <= 0:
+            return 0
+        amount = min(amount, self.per_minute)
+        with self.lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) * 60.0 / self.per_minute
+
+    def acquire(self, amount=1):
+        while (wait := self.reserve(amount)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, amount=1):
+        while (wait := self.reserve(amount)) > 0:
+            await asyncio.sleep(wait)
+
+    def debit(self, amount):
+        if self.per_minute <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+
+class SchedulerClosed(Exception):
+    """The job had not started when its scheduler was closed."""
+
+
+class Job:
+    def __init__(self, fn, args, priority, meta, group=None):
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.meta = meta
+        self.group = group
+        self.attempts = 0
+        self.queued = time.monotonic()
+        self.future = Future()
+
+
+class FairQueue:
+    """Jobs queued per group (study), served fairly across groups.
+
+    The next job comes from the group with the fewest jobs running, so
+    every study gets an equal share of the in-flight budget however many
+    prompts it queued; ties go to the lowest `priority`, then to the oldest
+    job. Callers provide the locking.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.active = {}
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def push(self, group, priority, item):
+        heapq.heappush(self.queues.setdefault(group, []), (priority, next(self.sequence), item))
+
+    def pop(self):
+        """Next (group, item), counted as running until `finished(group)`."""
+        group = min(self.queues, key=lambda group: (self.active.get(group, 0), self.queues[group][0][:2]))
+        queue = self.queues[group]
+        item = heapq.heappop(queue)[2]
+        if not queue:
+            del self.queues[group]
+        self.started(group)
+        return group, item
+
+    def started(self, group):
+        self.active[group] = self.active.get(group, 0) + 1
+
+    def finished(self, group):
+        self.active[group] -= 1
+        if not self.active[group]:
+            del self.active[group]
+
+
+class LLMScheduler:
+    """Process-wide queue that every model request goes through.
+
+    At most `max_in_flight` jobs run at once, each start is gated by the
+    request and token rate limiters, and running slots are shared fairly
+    between `group`s (studies), lower `priority` values first within them.
+    Failed jobs are retried with exponential backoff and full jitter; after
+    `max_retries` retries the job is handed to `dead_letter(job, error)` and
+    its future fails. `close` fails every job that has not started with
+    SchedulerClosed and lets the running ones finish.
+    """
+
+    def __init__(self, max_in_flight, requests_per_minute=0, tokens_per_minute=0,
+                 max_retries=5, backoff_base=2.0, backoff_max=60.0, dead_letter=None):
+        self.requests = RateLimiter(requests_per_minute)
+        self.tokens = RateLimiter(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dead_letter = dead_letter
+        self.cond = threading.Condition()
+        self.ready = FairQueue()
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.closed = False
+        for _ in range(max_in_flight):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, fn, *args, priority=1, meta=None, group=None):
+        job = Job(fn, args, priority, meta or {}, group)
+        with self.cond:
+            if self.closed:
+                job.future.set_exception(SchedulerClosed(job.meta))
+                return job.future
+            self.ready.push(job.group, job.priority, job)
+            self.cond.notify()
+        return job.future
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            jobs = [item for queue in self.ready.queues.values() for _, _, item in queue]
+            jobs += [job for _, _, job in self.delayed]
+            self.ready.queues.clear()
+            self.delayed = []
+        for job in jobs:
+            job.future.set_exception(SchedulerClosed(job.meta))
+        return len(jobs)
+
+    def depth(self):
+        with self.cond:
+            return len(self.ready) + len(self.delayed)
+
+    def _next_job(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self.delayed)
+                    job.queued = now
+                    self.ready.push(job.group, job.priority, job)
+                if self.ready.queues:
+                    _, job = self.ready.pop()
+                    metrics.llm_wait.observe(now - job.queued)
+                    return job
+                self.cond.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def _finished(self, job):
+        with self.cond:
+            self.ready.finished(job.group)
+
+    def _retry_later(self, job):
+        delay = backoff_delay(job.attempts, self.backoff_base, self.backoff_max)
+        with self.cond:
+            if self.closed:
+                return False
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), job))
+            self.cond.notify()
+        return True
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            self.requests.acquire()
+            self.tokens.acquire(0)
+            job.attempts += 1
+            try:
+                result = job.fn(*job.args)
+            except Exception as e:
+                self._finished(job)
+                logger.warning(f"Error processing prompt {job.meta} (attempt {job.attempts}): {e}")
+                if job.attempts <= self.max_retries:
+                    if self._retry_later(job):
+                        metrics.llm_retries.inc()
+                    else:
+                        job.future.set_exception(SchedulerClosed(job.meta))
+                    continue
+                metrics.llm_dead_letters.inc()
+                if self.dead_letter is not None:
+                    try:
+                        self.dead_letter(job, e)
+                    except Exception as dead_letter_error:
+                        logger.error(f"Error dead-lettering {job.meta}: {dead_letter_error}")
+                job.future.set_exception(e)
+                continue
+            self._finished(job)
+            debit_usage(self.tokens, result)
+            job.future.set_result(result)
+
+
+def debit_usage(tokens, result):
+    usage = getattr(result, 'usage_metadata', None)
+    if usage is not None:
+        tokens.debit(getattr(usage, 'total_token_count', 0))
+
+
+def backoff_delay(attempts, base, maximum):
+    # Full jitter
+    return random.uniform(0, min(maximum, base * 2 ** (attempts - 1)))
+
+
+class AsyncLLMScheduler:
+    """Coroutine counterpart of LLMScheduler for the asyncio engine.
+
+    Same in-flight budget, rate limits, priorities, backoff, dead-lettering
+    and `close`; `dead_letter` may be a coroutine function. Must be used from
+    one event loop.
+    """
+
+    def __init__(self, max_in_flight, requests_per_minute=0, tokens_per_minute=0,
+                 max_retries=5, backoff_base=2.0, backoff_max=60.0, dead_letter=None):
+        self.requests = RateLimiter(requests_per_minute)
+        self.tokens = RateLimiter(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dead_letter = dead_letter
+        self.free = max_in_flight
+        self.waiters = FairQueue()
+        self.closed = False
+
+    def depth(self):
+        return len(self.waiters)
+
+    def close(self):
+        self.closed = True
+        waiters = [item for queue in self.waiters.queues.values() for _, _, item in queue]
+        self.waiters.queues.clear()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(SchedulerClosed())
+        return len(waiters)
+
+    async def _acquire(self, job):
+        job.queued = time.monotonic()
+        if self.free > 0 and not self.waiters.queues:
+            self.free -= 1
+            self.waiters.started(job.group)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.push(job.group, job.priority, waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Cancelled after the slot was handed over
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self._release(job.group)
+            raise
+        finally:
+            metrics.llm_wait.observe(time.monotonic() - job.queued)
+
+    def _release(self, group):
+        self.waiters.finished(group)
+        while self.waiters.queues:
+            waiting_group, waiter = self.waiters.pop()
+            if not waiter.done():
+                # The slot passes straight to the waiter
+                waiter.set_result(None)
+                return
+            self.waiters.finished(waiting_group)
+        self.free += 1
+
+    async def run(self, fn, *args, priority=1, meta=None, group=None):
+        job = Job(fn, args, priority, meta or {}, group)
+        while True:
+            if self.closed:
+                raise SchedulerClosed(job.meta)
+            await self._acquire(job)
+            try:
+                await self.requests.acquire_async()
+                await self.tokens.acquire_async(0)
+                job.attempts += 1
+                result = await job.fn(*job.args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Error processing prompt {job.meta} (attempt {job.attempts}): {e}")
+                error = e
+            else:
+                debit_usage(self.tokens, result)
+                return result
+            finally:
+                self._release(job.group)
+            if job.attempts > self.max_retries:
+                metrics.llm_dead_letters.inc()
+                if self.dead_letter is not None:
+                    try:
+                        outcome = self.dead_letter(job, error)
+                        if inspect.isawaitable(outcome):
+                            await outcome
+                    except Exception as dead_letter_error:
+                        logger.error(f"Error dead-lettering {job.meta}: {dead_letter_error}")
+                raise error
+            metrics.llm_retries.inc()
+            await asyncio.sleep(backoff_delay(job.attempts, self.backoff_base, self.backoff_max))
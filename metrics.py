@@ -0,0 +1,218 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("cr_analyzer")
+except ImportError:
+    tracer = None
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for key, value in labels.items()}
+    pairs = ','.join(f'{key}="{value}"' for key, value in sorted(escaped.items()))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{_label_text(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                labels = dict(key)
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_label_text({**labels, 'le': bound})} {bucket}")
+                lines.append(f"{self.name}_bucket{_label_text({**labels, 'le': '+Inf'})} {count}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {total}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Value read from `fn()` at scrape time."""
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.fn()}"]
+
+
+registry = []
+
+
+def counter(name, help):
+    metric = Counter(name, help)
+    registry.append(metric)
+    return metric
+
+
+def histogram(name, help):
+    metric = Histogram(name, help)
+    registry.append(metric)
+    return metric
+
+
+def gauge(name, help, fn):
+    for metric in registry:
+        if metric.name == name:
+            # Re-registered: read from the new source
+            metric.fn = fn
+            return metric
+    metric = Gauge(name, help, fn)
+    registry.append(metric)
+    return metric
+
+
+stage_seconds = histogram('pipeline_stage_seconds', 'Wall time of each pipeline stage')
+stage_errors = counter('pipeline_stage_errors_total', 'Pipeline stages that raised')
+llm_tokens = counter('llm_tokens_total', 'Gemini tokens by analysis and kind, from usage_metadata')
+llm_retries = counter('llm_retries_total', 'Model requests retried after an error')
+llm_dead_letters = counter('llm_dead_letters_total', 'Model requests that exhausted their retries')
+s3_bytes = counter('s3_download_bytes_total', 'Bytes downloaded from S3')
+study_wait = histogram('study_queue_wait_seconds', 'Time due studies waited for a worker')
+llm_wait = histogram('llm_queue_wait_seconds', 'Time model requests waited for an in-flight slot')
+
+
+@contextmanager
+def stage(name, labels=None, **attributes):
+    """Time a pipeline stage.
+
+    `labels` become metric labels, so keep them low-cardinality (analysis
+    type, collection); `attributes` such as study_id and filter only go to
+    the JSON log line and the OpenTelemetry span.
+    """
+    labels = {'stage': name, **(labels or {})}
+    span = tracer.start_as_current_span(name, attributes={**labels, **attributes}) if tracer else None
+    if span is not None:
+        span.__enter__()
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException as e:
+        status = 'error'
+        stage_errors.inc(**labels)
+        if span is not None:
+            span.__exit__(type(e), e, e.__traceback__)
+            span = None
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, **labels)
+        logger.info("stage finished", extra={'fields': {**labels, **attributes, 'seconds': round(elapsed, 4),
+                                                      'status': status}})
+        if span is not None:
+            span.__exit__(None, None, None)
+
+
+def record_usage(response, analysis):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    for kind in ('prompt_token_count', 'candidates_token_count', 'cached_content_token_count', 'total_token_count'):
+        value = getattr(usage, kind, 0) or 0
+        if value:
+            llm_tokens.inc(value, analysis=analysis, kind=kind.replace('_token_count', ''))
+
+
+def propagate(fn):
+    """Run `fn` in the caller's context (current span) from another thread."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port):
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                 'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging(level):
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
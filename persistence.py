@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# analysis_results: one document per S3 output, _id is the S3 key
+RESULT_INDEXES = [IndexModel([('study_id', ASCENDING), ('filter', ASCENDING), ('analysis', ASCENDING)]),
+                  IndexModel([('study_id', ASCENDING), ('updated_at', ASCENDING)])]
+
+
+def usage_fields(response):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return {}
+    return {kind.replace('_token_count', ''): getattr(usage, kind, 0) or 0
+            for kind in ('prompt_token_count', 'candidates_token_count', 'cached_content_token_count',
+                         'total_token_count')}
+
+
+def result_update(study_id, filter, analysis, key, etag, request, response, seconds, input_hash):
+    """Upsert for one output; `request` names the model request it came from (a group for sections)."""
+    return UpdateOne({'_id': key}, {'$set': {'study_id': study_id, 'filter': filter, 'analysis': analysis,
+                                             'etag': etag, 'request': request, 'usage': usage_fields(response),
+                                             'generation_seconds': round(seconds, 3), 'input_hash': input_hash,
+                                             'updated_at': datetime.now()}}, upsert=True)
+
+
+class ResultBatch:
+    """Outputs of one study run.
+
+    `put` writes an output to S3 on the shared persistence pool, so model
+    slots are not held while uploading. Outputs are indexed in
+    analysis_results, which is also the result cache, with one bulk_write
+    per `flush_size` outputs or `flush_seconds`, whichever comes first, so
+    a run killed mid-study keeps almost everything it already wrote.
+    `flush` indexes whatever is still pending.
+    """
+
+    def __init__(self, study_id, s3, bucket, executor, collection, flush_size=10, flush_seconds=5.0):
+        self.study_id = study_id
+        self.s3 = s3
+        self.bucket = bucket
+        self.executor = executor
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.updates = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flushed_at = time.monotonic()
+
+    def add(self, update):
+        with self.lock:
+            self.updates.append(update)
+            due = len(self.updates) >= self.flush_size or time.monotonic() - self.flushed_at >= self.flush_seconds
+        if due:
+            try:
+                self.flush()
+            except Exception as e:
+                # Retried by the next flush; the study's last one reports a persistent failure
+                logger.warning(f"Error indexing results of study {self.study_id}: {e}")
+
+    def put(self, key, body, describe, labels=None):
+        """Upload `body` to `key`; `describe(etag)` builds its analysis_results update."""
+        def write():
+            with metrics.stage('s3_put', labels, study_id=self.study_id, key=key):
+                etag = self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)['ETag']
+            self.add(describe(etag))
+        return self.executor.submit(metrics.propagate(write))
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                updates, self.updates = self.updates, []
+                self.flushed_at = time.monotonic()
+            if not updates:
+                return 0
+            try:
+                with metrics.stage('mongo_write', {'collection': 'analysis_results'}, study_id=self.study_id):
+                    self.collection.bulk_write(updates, ordered=False)
+            except BaseException:
+                # Kept for the next flush; the upserts are idempotent
+                with self.lock:
+                    self.updates[:0] = updates
+                raise
+        return len(updates)
+
+
+class AsyncResultBatch:
+    """ResultBatch's indexing for the async engine, whose outputs are written by coroutines."""
+
+    def __init__(self, study_id, collection, flush_size=10, flush_seconds=5.0):
+        self.study_id = study_id
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.updates = []
+        self.flushed_at = time.monotonic()
+
+    async def add(self, update):
+        self.updates.append(update)
+        if len(self.updates) >= self.flush_size or time.monotonic() - self.flushed_at >= self.flush_seconds:
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"Error indexing results of study {self.study_id}: {e}")
+
+    async def flush(self):
+        updates, self.updates = self.updates, []
+        self.flushed_at = time.monotonic()
+        if not updates:
+            return 0
+        try:
+            with metrics.stage('mongo_write', {'collection': 'analysis_results'}, study_id=self.study_id):
+                await self.collection.bulk_write(updates, ordered=False)
+        except BaseException:
+            self.updates[:0] = updates
+            raise
+        return len(updates)
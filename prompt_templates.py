@@ -0,0 +1,53 @@
+import hashlib
+import os
+from string import Template
+
+# Line separating a template's study-wide text from its per-filter text
+FILTER_MARKER = '<<<POR FILTRO>>>'
+
+
+class PromptTemplates:
+    """Analysis prompts loaded and checked once from a template directory.
+
+    Each analysis has a `<analysis>.md` file written for `string.Template`.
+    The text before the `<<<POR FILTRO>>>` line may only use `$study_id`, so
+    every filter of a study sends the same prompt prefix; the text after it
+    is rendered per filter with `$filter` (`_filtro.md` when the file has no
+    such line). `$reglas` inserts the rules shared by all analyses from
+    `_reglas.md`. `version` names the directory and fingerprints its
+    contents, so results can record which templates built them.
+    """
+
+    def __init__(self, directory, analyses):
+        digest = hashlib.sha256()
+
+        def read(name):
+            with open(os.path.join(directory, f"{name}.md"), encoding='utf-8') as f:
+                text = f.read()
+            digest.update(name.encode('utf-8') + b'\0' + text.encode('utf-8') + b'\0')
+            return text
+
+        self.rules = read('_reglas').strip()
+        default_suffix = read('_filtro')
+        self.templates = {}
+        for analysis in analyses:
+            prefix, marker, suffix = read(analysis).partition(FILTER_MARKER)
+            self.templates[analysis] = (_compile(prefix, {'study_id', 'reglas'}, analysis),
+                                        _compile(suffix if marker else default_suffix, {'filter'}, analysis))
+        self.version = f"{os.path.basename(os.path.normpath(directory))}-{digest.hexdigest()[:12]}"
+
+    def render(self, analysis, study_id, filter):
+        prefix, suffix = self.templates[analysis]
+        parts = [prefix.substitute(study_id=study_id, reglas=self.rules).strip(), suffix.substitute(filter=filter).strip()]
+        return "\n\n".join(part for part in parts if part)
+
+
+def _compile(text, allowed, analysis):
+    template = Template(text)
+    if not template.is_valid():
+        raise ValueError(f"Invalid placeholder in the {analysis} prompt template")
+    unknown = set(template.get_identifiers()) - allowed
+    if unknown:
+        raise ValueError(f"The {analysis} prompt template uses {', '.join(sorted(unknown))} where only "
+                         f"{', '.join(sorted(allowed))} can be used")
+    return template
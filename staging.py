@@ -0,0 +1,158 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha1
+
+logger = logging.getLogger(__name__)
+
+
+class Staging:
+    """Local disk area for the files a study run works on.
+
+    Every run gets its own directory under `root/runs`, removed when the run
+    ends however it ends, so two runs of the same study never share files.
+    Downloaded objects are also kept in `root/blobs`, keyed by S3 key and
+    ETag, and hard-linked into later runs instead of being fetched again.
+    Blobs and the files of runs in progress are held under `quota` bytes by
+    evicting the least recently used blobs; a run keeps its own links, so
+    eviction never pulls a file from under it. `sweep` refreshes what the runs
+    take and removes the directories of runs that crashed.
+    """
+
+    def __init__(self, root, quota, stale_after=24 * 3600):
+        self.root = root
+        self.quota = quota
+        self.stale_after = stale_after
+        self.runs = os.path.join(root, 'runs')
+        self.blobs = os.path.join(root, 'blobs')
+        self.lock = threading.Lock()
+        self.sizes = OrderedDict()
+        self.used = 0
+        # Run directories of this process, and the bytes of every run as of the last sweep
+        self.active = set()
+        self.run_bytes = 0
+        os.makedirs(self.runs, exist_ok=True)
+        os.makedirs(self.blobs, exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        # Blobs kept by earlier processes
+        blobs = []
+        for name in os.listdir(self.blobs):
+            stat = os.stat(os.path.join(self.blobs, name))
+            blobs.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(blobs):
+            self.sizes[name] = size
+            self.used += size
+        self.sweep()
+
+    def sweep(self):
+        """Remove the run directories left by crashed runs and count the rest against the quota.
+
+        Directories this process is not using may belong to another process
+        sharing the root, so they are only removed once untouched for
+        `stale_after` seconds.
+        """
+        now = time.time()
+        with self.lock:
+            active = set(self.active)
+        run_bytes = 0
+        for name in os.listdir(self.runs):
+            path = os.path.join(self.runs, name)
+            try:
+                if path not in active and now - os.path.getmtime(path) > self.stale_after:
+                    shutil.rmtree(path, ignore_errors=True)
+                    continue
+            except FileNotFoundError:
+                # The run ended meanwhile
+                continue
+            run_bytes += _unlinked_size(path)
+        with self.lock:
+            self.run_bytes = run_bytes
+            self._evict()
+
+    @contextmanager
+    def run(self, study_id):
+        path = os.path.join(self.runs, f"{study_id}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(path)
+        with self.lock:
+            self.active.add(path)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            with self.lock:
+                self.active.discard(path)
+
+    def _blob(self, key, etag):
+        return sha1(f"{key}\0{etag}".encode('utf-8')).hexdigest()
+
+    def link(self, key, etag, path):
+        """Place the stored copy of `key` at `path`; False if there is none."""
+        name = self._blob(key, etag)
+        with self.lock:
+            if name not in self.sizes:
+                return False
+            self.sizes.move_to_end(name)
+            try:
+                _link_or_copy(os.path.join(self.blobs, name), path)
+            except FileNotFoundError:
+                # Removed behind our back
+                self.used -= self.sizes.pop(name)
+                return False
+        return True
+
+    def add(self, key, etag, path):
+        """Keep the file just downloaded to `path` for later runs."""
+        name = self._blob(key, etag)
+        size = os.path.getsize(path)
+        if size > self.quota:
+            return
+        with self.lock:
+            if name in self.sizes:
+                return
+            try:
+                _link_or_copy(path, os.path.join(self.blobs, name))
+            except OSError as e:
+                logger.warning(f"Could not keep {key} in the staging store: {e}")
+                return
+            self.sizes[name] = size
+            self.used += size
+            self._evict()
+
+    def _evict(self):
+        while self.used + self.run_bytes > self.quota and self.sizes:
+            name, size = self.sizes.popitem(last=False)
+            self.used -= size
+            try:
+                os.remove(os.path.join(self.blobs, name))
+            except FileNotFoundError:
+                pass
+
+
+def _unlinked_size(path):
+    # Files also linked as blobs are counted with the blobs
+    size = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink == 1:
+                size += stat.st_size
+    return size
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if isinstance(e, FileNotFoundError):
+            raise
+        shutil.copyfile(source, target)
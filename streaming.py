@@ -0,0 +1,62 @@
+import time
+
+# S3 rejects multipart parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class StreamBuffer:
+    """Generated text waiting to be written as S3 parts and progress updates.
+
+    Only the unflushed tail of a response is held: bytes until a multipart
+    part is full, and text until the next progress update is due.
+    """
+
+    def __init__(self, part_size, progress_interval):
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.progress_interval = progress_interval
+        self.buffer = bytearray()
+        self.delta = []
+        self.flushed = time.monotonic()
+        self.parts = []
+
+    def add(self, text):
+        self.buffer += text.encode('utf-8')
+        self.delta.append(text)
+
+    def full_part(self):
+        return len(self.buffer) >= self.part_size
+
+    def take_part(self):
+        body = bytes(self.buffer)
+        self.buffer.clear()
+        return body
+
+    def add_part(self, etag):
+        self.parts.append({'ETag': etag, 'PartNumber': len(self.parts) + 1})
+
+    def next_part_number(self):
+        return len(self.parts) + 1
+
+    def take_delta(self, force=False):
+        """Text generated since the last progress update, once one is due."""
+        now = time.monotonic()
+        if not self.delta or not (force or now - self.flushed >= self.progress_interval):
+            return None
+        self.flushed = now
+        text = ''.join(self.delta)
+        self.delta.clear()
+        return text
+
+
+def start_progress(meta, started_at):
+    return {'$set': {**meta, 'text': '', 'status': 'generating', 'started_at': started_at, 'updated_at': started_at}}
+
+
+def end_progress(status, updated_at):
+    return {'$set': {'status': status, 'updated_at': updated_at}}
+
+
+def append_progress(delta, updated_at):
+    # Appends server-side so the progress document never has to be re-sent whole
+    return [{'$set': {'text': {'$concat': [{'$ifNull': ['$text', '']}, {'$literal': delta}]},
+                      'updated_at': {'$literal': updated_at}}}]
@@ -0,0 +1,373 @@
+import csv
+import hashlib
+import io
+import re
+import threading
+import unicodedata
+from array import array
+
+# Columns with more distinct answers than this are treated as free text
+MAX_CATEGORIES = 25
+# Columns with more distinct answers than this are not indexed, so filters on them use the full file
+MAX_INDEXED_ANSWERS = 1000
+# 0-10 recommendation scale: detractors up to 6, promoters from 9
+NPS_SCALE = range(0, 11)
+NPS_DETRACTOR_MAX = 6
+NPS_PROMOTER_MIN = 9
+# A column's top answer must reach this to be read as 0-10 rather than a 1-5 or 1-7 scale
+NPS_SCALE_MIN_TOP = 8
+# Recommendation questions, matched against the normalized header
+NPS_HEADER = re.compile(r'recomend|recommend|\bnps\b')
+# Respondent segments the statistics are broken down by, unless columns are named explicitly
+SEGMENT_HEADER = re.compile(r'genero|sexo|edad|rango|ciudad|region|pais|zona|segmento|nivel socio|\bnse\b|ocupacion')
+MAX_SEGMENTS = 8
+# Answer codes are 1-based positions among a column's answers, 0 when unanswered. A segment code
+# times CODE_BASE plus an answer code stays below 256 (8 * 26 + 25), so a cross still takes one byte per row
+CODE_BASE = MAX_CATEGORIES + 1
+FILTER_SEPARATORS = re.compile(r'\s*[;&]\s*')
+CONDITION = re.compile(r'^(?P<column>[^:=]+?)\s*[:=]\s*(?P<value>.+)$')
+
+
+def normalize(text):
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    return ' '.join(''.join(c for c in decomposed if not unicodedata.combining(c)).casefold().split())
+
+
+class _Lines:
+    """Decoded lines of a binary file, counting the bytes read so far."""
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+
+class SurveyData:
+    """Survey CSV indexed in one streaming pass over the file.
+
+    Only a per-column index of normalized answers, the byte range and hash of
+    every row are kept; the rows a filter selects are read back from the file
+    when needed, so the file must stay in place while the instance is used.
+    Filters of the form "Columna: Valor" (or "Columna = Valor", several joined
+    with ";" or "&") are resolved against the index so each filter's rows and
+    answer statistics can be sent to the model instead of the whole file.
+    The statistics are counted from the same index, so answers are only
+    normalized once however many filters a study has.
+    """
+
+    def __init__(self, path, name, nps_columns=(), segment_columns=()):
+        self.path = path
+        self.name = name
+        # Headers named explicitly; otherwise NPS_HEADER and SEGMENT_HEADER pick the columns
+        self.nps_names = {normalize(column) for column in nps_columns}
+        self.segment_names = {normalize(column) for column in segment_columns}
+        self.starts = array('q')
+        self.ends = array('q')
+        # sha1 digests of the rows, 20 bytes each in row order
+        self.row_hashes = bytearray()
+        self.lock = threading.Lock()
+        with open(path, 'rb') as f:
+            lines = _Lines(f)
+            reader = csv.reader(lines)
+            self.header = next(reader, [])
+            self.columns = {normalize(column): i for i, column in enumerate(self.header)}
+            self.index = [{} for _ in self.header]
+            # First spelling of each normalized answer, as shown in the statistics
+            self.labels = [{} for _ in self.header]
+            while True:
+                start = lines.offset
+                row = next(reader, None)
+                if row is None:
+                    break
+                if not any(cell.strip() for cell in row):
+                    continue
+                self._add(len(self.starts), row)
+                self.starts.append(start)
+                self.ends.append(lines.offset)
+                self.row_hashes += hashlib.sha1('\x1f'.join(row).encode('utf-8')).digest()
+        self.file = None
+        # The index is complete, so which columns are categorical, NPS and segments is fixed from here
+        self.categorical_ids = [i for i in range(len(self.header))
+                                if self.index[i] is not None and 1 < len(self.index[i]) <= MAX_CATEGORIES
+                                and len(self.index[i]) < len(self)]
+        self.nps_ids = [i for i in self.categorical_ids if self._is_nps(i)]
+        self.segment_ids = [i for i in self.categorical_ids if i not in self.nps_ids and self._is_segment(i)]
+        self.codes = {i: self._codes(i) for i in self.categorical_ids}
+
+    def _add(self, row_id, row):
+        for i, value in enumerate(row[:len(self.header)]):
+            index = self.index[i]
+            if index is None:
+                continue
+            key = normalize(value)
+            ids = index.get(key)
+            if ids is None:
+                if len(index) >= MAX_INDEXED_ANSWERS:
+                    self.index[i] = self.labels[i] = None
+                    continue
+                ids = index[key] = array('I')
+                self.labels[i][key] = value.strip()
+            ids.append(row_id)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def load(cls, path, name, nps_columns=(), segment_columns=()):
+        return cls(path, name, nps_columns, segment_columns)
+
+    def resolve(self, filter):
+        """Row ids matching `filter`, or None if it does not map onto the recorded columns and answers."""
+        if not isinstance(filter, str):
+            return None
+        matches = None
+        for condition in FILTER_SEPARATORS.split(filter.strip()):
+            parsed = CONDITION.match(condition)
+            if parsed is None:
+                return None
+            column = self.columns.get(normalize(parsed.group('column')))
+            if column is None or self.index[column] is None:
+                return None
+            rows = self.index[column].get(normalize(parsed.group('value')))
+            if rows is None:
+                # Not one of the recorded answers: the model reads the filter against the full file
+                return None
+            matches = set(rows) if matches is None else matches & set(rows)
+        return sorted(matches) if matches is not None else None
+
+    def read_rows(self, row_ids):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'rb')
+            chunks = []
+            for row_id in row_ids:
+                self.file.seek(self.starts[row_id])
+                chunks.append(self.file.read(self.ends[row_id] - self.starts[row_id]).decode('utf-8'))
+        return csv.reader(io.StringIO(''.join(chunks)))
+
+    def to_csv(self, row_ids):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.header)
+        writer.writerows(self.read_rows(row_ids))
+        return buffer.getvalue()
+
+    def write_csv(self, filter, path):
+        """Write the rows `filter` selects, with the header, to `path`."""
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(self.to_csv(self.resolve(filter)))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _codes(self, i):
+        """Answer code of every row for column `i`, with the code of each answer.
+
+        The codes are packed one byte per row into a single integer, so a
+        subset mask or a cross with another column costs a few big integer
+        operations rather than a Python loop over the rows.
+        """
+        codes = bytearray(len(self))
+        answers = {}
+        for code, key in enumerate((key for key in self.index[i] if key), 1):
+            answers[key] = code
+            for row_id in self.index[i][key]:
+                codes[row_id] = code
+        return int.from_bytes(codes, 'big'), answers
+
+    def _mask(self, row_ids):
+        # 0xff for the rows in `row_ids`, None when they are every row
+        if len(row_ids) >= len(self):
+            return None
+        mask = bytearray(len(self))
+        for row_id in row_ids:
+            mask[row_id] = 0xff
+        return int.from_bytes(mask, 'big')
+
+    def _counts(self, packed, codes):
+        # Rows with each of `codes` in packed one-byte codes
+        data = packed.to_bytes(len(self), 'big')
+        return {code: data.count(code) for code in codes}
+
+    def categorical_columns(self):
+        # Free text and identifier-like columns are left out of the statistics
+        return list(self.categorical_ids)
+
+    def frequencies(self, row_ids, mask=None):
+        """Answer counts of every categorical question over `row_ids`.
+
+        Returns (column, [(normalized answer, count), ...]) pairs, most
+        frequent answer first and ties in order of first appearance in the
+        file; unanswered cells are left out. `mask` is `_mask(row_ids)`, when
+        the caller already has it.
+        """
+        if mask is None:
+            mask = self._mask(row_ids)
+        tables = []
+        for i in self.categorical_ids:
+            packed, answers = self.codes[i]
+            if mask is None:
+                counts = [(key, len(self.index[i][key])) for key in answers]
+            else:
+                found = self._counts(packed & mask, answers.values())
+                counts = [(key, found[code]) for key, code in answers.items()]
+            counts = [(key, count) for key, count in counts if count]
+            if counts:
+                tables.append((i, sorted(counts, key=lambda item: -item[1])))
+        return tables
+
+    def _is_nps(self, i):
+        header = normalize(self.header[i])
+        if not (header in self.nps_names if self.nps_names else NPS_HEADER.search(header)):
+            return False
+        keys = [key for key in self.index[i] if key]
+        return bool(keys) and all(key.isdigit() and int(key) in NPS_SCALE for key in keys) \
+            and max(int(key) for key in keys) >= NPS_SCALE_MIN_TOP
+
+    def _is_segment(self, i):
+        header = normalize(self.header[i])
+        if not (header in self.segment_names if self.segment_names else SEGMENT_HEADER.search(header)):
+            return False
+        return len([key for key in self.index[i] if key]) <= MAX_SEGMENTS
+
+    def nps_columns(self):
+        """Recommendation questions answered only with whole numbers on the 0-10 scale."""
+        return list(self.nps_ids)
+
+    def segment_columns(self):
+        return list(self.segment_ids)
+
+    def nps_line(self, label, counts):
+        """NPS summary of (answer, count) pairs on the 0-10 scale."""
+        answered = sum(count for _, count in counts)
+        if not answered:
+            return None
+        promoters = sum(count for key, count in counts if int(key) >= NPS_PROMOTER_MIN)
+        passives = sum(count for key, count in counts if NPS_DETRACTOR_MAX < int(key) < NPS_PROMOTER_MIN)
+        detractors = sum(count for key, count in counts if int(key) <= NPS_DETRACTOR_MAX)
+        return (f"- {label}: NPS {(promoters - detractors) * 100 / answered:+.1f} "
+                f"(Promotores {promoters * 100 / answered:.1f}%, Indiferentes {passives * 100 / answered:.1f}%, "
+                f"Detractores {detractors * 100 / answered:.1f}%; {answered} respuestas)")
+
+    def nps(self, tables):
+        """NPS lines for the recommendation questions among `frequencies` tables."""
+        lines = [self.nps_line(self.header[i], counts) for i, counts in tables if i in self.nps_ids]
+        return [line for line in lines if line]
+
+    def breakdowns(self, row_ids, tables, mask=None):
+        """Markdown breakdown of every `frequencies` table by each segment column present in `row_ids`."""
+        if mask is None:
+            mask = self._mask(row_ids)
+        lines = []
+        for s in self.segment_ids:
+            # Row -> segment code of the row, 0 for rows outside `row_ids` or unanswered
+            codes, segments = self.codes[s]
+            if mask is not None:
+                codes &= mask
+            sizes = self._counts(codes, segments.values())
+            present = [code for code in segments.values() if sizes[code]]
+            if len(present) < 2:
+                # The filter already fixes this segment
+                continue
+            labels = {code: self.labels[s][key] for key, code in segments.items()}
+            lines.append(f"### Por {self.header[s]}: " + " | ".join(
+                f"{labels[code]} ({sizes[code]})" for code in present))
+            # Rows outside every segment fall below CODE_BASE and are never looked up
+            scaled = codes * CODE_BASE
+            for i, counts in tables:
+                if i == s or len(counts) < 2:
+                    continue
+                # Answer counts per segment, in the order of the filter-wide table
+                packed, answers = self.codes[i]
+                crossed = self._counts(scaled + packed, [code * CODE_BASE + answers[key]
+                                                         for code in present for key, _ in counts])
+                by_segment = {code: [(key, crossed[code * CODE_BASE + answers[key]]) for key, _ in counts]
+                              for code in present}
+                answered = {code: sum(count for _, count in by_segment[code]) for code in present}
+                if i in self.nps_ids:
+                    lines += [line for line in (self.nps_line(f"{self.header[i]} | {labels[code]}", by_segment[code])
+                                                for code in present) if line]
+                    continue
+                lines.append(f"- {self.header[i]}")
+                for n, (key, _) in enumerate(counts):
+                    lines.append(f"  - {self.labels[i][key]}: " + " | ".join(
+                        f"{by_segment[code][n][1] * 100 / answered[code]:.1f}%" if answered[code] else "-"
+                        for code in present))
+        return lines
+
+    def statistics(self, row_ids):
+        """Markdown frequency table of every categorical question over `row_ids`, plus NPS and segments."""
+        lines = []
+        mask = self._mask(row_ids)
+        tables = self.frequencies(row_ids, mask)
+        for i, counts in tables:
+            answered = sum(count for _, count in counts)
+            lines.append(f"### {self.header[i]}")
+            for key, count in counts:
+                lines.append(f"- {self.labels[i][key]}: {count * 100 / answered:.1f}% ({count}/{answered})")
+        nps = self.nps(tables)
+        if nps:
+            lines += ["### NPS (0-6 detractores, 7-8 indiferentes, 9-10 promotores)", *nps]
+        breakdowns = self.breakdowns(row_ids, tables, mask)
+        if breakdowns:
+            lines += ["## Por segmento (porcentaje de cada respuesta dentro de cada segmento, en el orden indicado)",
+                      *breakdowns]
+        return f"Total de respuestas: {len(row_ids)}\n\n" + "\n".join(lines)
+
+    def filter_parts(self, filter, inline_limit=None):
+        """Prompt parts describing the survey data for `filter`.
+
+        Returns (parts, subset, attach): `subset` is False when the filter
+        could not be resolved locally, in which case the uploaded file must be
+        sent. Filtered rows taking more than `inline_limit` bytes are left out
+        of the parts and `attach` is True: the caller sends them as a file,
+        written with `write_csv`.
+        """
+        if filter == 'General':
+            row_ids = list(range(len(self)))
+            subset = False
+        else:
+            row_ids = self.resolve(filter)
+            if row_ids is None:
+                return [], False, False
+            subset = True
+        parts = []
+        attach = subset and inline_limit is not None and sum(self.ends[i] - self.starts[i] for i in row_ids) > inline_limit
+        if attach:
+            parts.append(f"El archivo adjunto contiene {self.name} filtrado por {filter} ({len(row_ids)} respuestas).")
+        elif subset:
+            parts.append(f"Contenido de {self.name} filtrado por {filter} ({len(row_ids)} respuestas):\n"
+                         f"```csv\n{self.to_csv(row_ids)}```")
+        parts.append(f"Estadísticas exactas precalculadas de {self.name} para el filtro {filter}. "
+                     f"Usa estos porcentajes tal cual, no los recalcules:\n{self.statistics(row_ids)}")
+        return parts, subset, attach
+
+    def digest(self, filter):
+        """Fingerprint of the responses `filter_parts` describes for `filter`.
+
+        Built from a hash of every row in the subset (every row for General
+        and unresolved filters, which send the whole file), independent of
+        row order, plus the header and the columns treated as categorical,
+        NPS questions and segments.
+        """
+        row_ids = self.resolve(filter) if filter != 'General' else None
+        if row_ids is None:
+            row_ids = range(len(self))
+        hashes = [bytes(self.row_hashes[i * 20:i * 20 + 20]) for i in row_ids]
+        digest = hashlib.sha256('\x1f'.join(self.header).encode('utf-8'))
+        digest.update(repr((self.categorical_ids, self.nps_ids, self.segment_ids)).encode('utf-8'))
+        for row_hash in sorted(hashes):
+            digest.update(row_hash)
+        return digest.hexdigest()
@@ -1,549 +1,1222 @@
 import os
+import sys
+import argparse
+import asyncio
+import logging
 import chardet
+import csv
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
 import boto3
+from botocore.config import Config
 import google.generativeai as genai
 import shutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+import hashlib
+import heapq
+import math
+import re
+import signal
+import threading
+import time
+import socket
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+from llm_scheduler import LLMScheduler, SchedulerClosed
+from file_cache import FileCache
+from survey_data import SurveyData
+from streaming import StreamBuffer, append_progress, end_progress, start_progress
+from context_cache import StudyContext
+from staging import Staging
+from persistence import RESULT_INDEXES, ResultBatch, result_update
+from prompt_templates import PromptTemplates
+import metrics
 
 load_dotenv()
 
-# MongoDB setup
-client = MongoClient(os.environ['MONGO_URI'])
-db = client['cheetah_research']
+logger = logging.getLogger(__name__)
+
+# Pinned version: context caching needs one, and prompts sent with and without a cache must
+# reach the same model. Result hashes include it, so changing it regenerates the analyses
+MODEL_NAME = os.environ.get('MODEL_NAME', 'models/gemini-1.5-pro-002')
+GENERATION_CONFIG = {"response_mime_type": "text/plain"}
+CONTEXT_CACHE = os.environ.get('CONTEXT_CACHE', '1') == '1'
+CONTEXT_CACHE_TTL_SECONDS = float(os.environ.get('CONTEXT_CACHE_TTL_SECONDS', 3600))
+# Shared by download workers, result writers and streamed uploads
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 50))
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', 5))
+# Threads writing analysis outputs to S3, apart from the model workers
+PERSIST_WORKERS = int(os.environ.get('PERSIST_WORKERS', 16))
+# Outputs are indexed in analysis_results, which doubles as the resume checkpoint,
+# in bulk writes of this many or at least this often while a study runs
+RESULT_FLUSH_SIZE = int(os.environ.get('RESULT_FLUSH_SIZE', 10))
+RESULT_FLUSH_SECONDS = float(os.environ.get('RESULT_FLUSH_SECONDS', 5))
+# Filtered survey rows above this size are uploaded, so context caching covers them, rather than sent inline
+SUBSET_INLINE_BYTES = int(os.environ.get('SUBSET_INLINE_BYTES', 256 * 1024))
+
+# Every generate_content call goes through the scheduler
+SCHEDULER_SETTINGS = dict(max_in_flight=int(os.environ.get('LLM_MAX_IN_FLIGHT', 8)),
+                          requests_per_minute=int(os.environ.get('LLM_REQUESTS_PER_MINUTE', 0)),
+                          tokens_per_minute=int(os.environ.get('LLM_TOKENS_PER_MINUTE', 0)),
+                          max_retries=int(os.environ.get('LLM_MAX_RETRIES', 5)),
+                          backoff_base=float(os.environ.get('LLM_BACKOFF_BASE', 2)),
+                          backoff_max=float(os.environ.get('LLM_BACKOFF_MAX', 60)))
+
+# Clients are created on first use and then shared by every thread, so
+# importing this module needs neither credentials nor network access
+clients = {}
+clients_lock = threading.Lock()
+# One lock per client, so a factory can use other clients (get_model needs get_genai)
+# and a slow one only holds up the threads waiting for that client
+client_locks = {}
+
+def shared_client(name, create):
+    if name not in clients:
+        with clients_lock:
+            lock = client_locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in clients:
+                clients[name] = create()
+    return clients[name]
+
+def get_db():
+    return shared_client('db', lambda: MongoClient(os.environ['MONGO_URI'])['cheetah_research'])
+
+def get_s3():
+    return shared_client('s3', lambda: boto3.client('s3', region_name='us-east-1',
+                                                    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                                                    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+                                                    config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                                                  retries={'max_attempts': S3_MAX_ATTEMPTS,
+                                                                           'mode': 'standard'})))
+
+def get_persist_executor():
+    return shared_client('persist', lambda: ThreadPoolExecutor(max_workers=PERSIST_WORKERS, thread_name_prefix='persist'))
+
+def get_results():
+    def create():
+        results = get_db()['analysis_results']
+        results.create_indexes(RESULT_INDEXES)
+        return results
+    return shared_client('results', create)
+
+def get_genai():
+    def configure():
+        genai.configure(api_key=os.environ['GEMINI_API_KEY'])
+        return genai
+    return shared_client('genai', configure)
+
+def get_model():
+    return shared_client('model', lambda: get_genai().GenerativeModel(MODEL_NAME, generation_config=GENERATION_CONFIG))
+
+def get_prompts():
+    return shared_client('prompts', lambda: PromptTemplates(PROMPT_DIR, ANALYSIS_FOLDERS))
+
+def get_staging():
+    return shared_client('staging', lambda: Staging(STAGING_DIR, STAGING_QUOTA_BYTES, STAGING_STALE_SECONDS))
+
+def dead_letter(job, error):
+    get_db()['llm_dead_letters'].insert_one({**job.meta, 'error': str(error), 'attempts': job.attempts, 'failed_at': datetime.now()})
+
+def get_scheduler():
+    return shared_client('scheduler', lambda: LLMScheduler(**SCHEDULER_SETTINGS, dead_letter=dead_letter))
+
+def scheduler_depth():
+    scheduler = clients.get('scheduler')
+    return scheduler.depth() if scheduler is not None else 0
+
+metrics.gauge('llm_queue_depth', 'Model requests waiting to run or to be retried', scheduler_depth)
+
+# Gemini uploads shared across filters and runs, keyed by S3 ETag
+file_cache = FileCache(ttl=float(os.environ.get('FILE_CACHE_TTL_SECONDS', 6 * 3600)),
+                       max_age=float(os.environ.get('FILE_CACHE_MAX_AGE_SECONDS', 46 * 3600)))
+FILE_CACHE_SWEEP_SECONDS = float(os.environ.get('FILE_CACHE_SWEEP_SECONDS', 300))
+
+# Study file downloads
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 8))
+# Per-run directories plus a store of downloaded objects, together kept under the quota
+STAGING_DIR = os.environ.get('STAGING_DIR', './storage')
+STAGING_QUOTA_BYTES = int(float(os.environ.get('STAGING_QUOTA_MB', 2048)) * 1024 * 1024)
+# Run directories untouched this long are taken as left by a crashed process
+STAGING_STALE_SECONDS = float(os.environ.get('STAGING_STALE_HOURS', 24)) * 3600
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+ENCODING_SAMPLE_BYTES = 64 * 1024
+
+# Versioned analysis prompt templates, read once per process
+PROMPT_DIR = os.environ.get('PROMPT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts', 'v1'))
+# Skip prompts whose inputs match the ones the indexed analysis in analysis_results was built from
+RESULT_CACHE = os.environ.get('RESULT_CACHE', '1') == '1'
+# Survey headers (';'-separated) of the 0-10 recommendation questions and of the respondent segments
+# the statistics are broken down by; empty picks them by header wording
+NPS_COLUMNS = [column.strip() for column in os.environ.get('NPS_COLUMNS', '').split(';') if column.strip()]
+SEGMENT_COLUMNS = [column.strip() for column in os.environ.get('SEGMENT_COLUMNS', '').split(';') if column.strip()]
+# Filters whose survey responses and study context are unchanged since their last complete run are skipped
+INCREMENTAL_ANALYSIS = os.environ.get('INCREMENTAL_ANALYSIS', '1') == '1'
+
+# Stream responses into S3 multipart uploads and an analysis_progress document
+STREAM_GENERATION = os.environ.get('STREAM_GENERATION', '0') == '1'
+STREAM_PART_SIZE = int(os.environ.get('STREAM_PART_SIZE', 5 * 1024 * 1024))
+STREAM_PROGRESS_SECONDS = float(os.environ.get('STREAM_PROGRESS_SECONDS', 2))
+
+# Analyses answered together in one multi-section request, e.g.
+# "segmentos,ekman,nps,personality,estilo;narrative,factual" (groups split by ';')
+PROMPT_GROUPS = [[key.strip() for key in group.split(',') if key.strip()]
+                 for group in os.environ.get('PROMPT_GROUPS', '').split(';') if group.strip()]
+SECTION_HEADER = re.compile(r'^<<<SECCION:\s*(\w+)\s*>>>\s*$', re.MULTILINE)
+
+# Ingestion setup
+WORKERS = int(os.environ.get('WORKERS', 5))
+INGEST_MODE = os.environ.get('INGEST_MODE', 'auto')  # auto | stream | poll
+LOG_DEBOUNCE_SECONDS = float(os.environ.get('LOG_DEBOUNCE_SECONDS', 60))
+POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', 0.5))
+POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', 30))
+# Ordering of due studies: large ones wait up to STUDY_SIZE_PENALTY_SECONDS behind small ones,
+# a log's numeric `priority` field moves it forward by STUDY_PRIORITY_BOOST_SECONDS per point
+QUEUE_SETTINGS = dict(size_weight=float(os.environ.get('STUDY_SIZE_WEIGHT_SECONDS', 30)),
+                      size_penalty=float(os.environ.get('STUDY_SIZE_PENALTY_SECONDS', 600)),
+                      priority_boost=float(os.environ.get('STUDY_PRIORITY_BOOST_SECONDS', 300)))
+# survey_logs leases, so several workers can share the collection
+WORKER_ID = os.environ.get('WORKER_ID', f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+LEASE_SECONDS = float(os.environ.get('LEASE_SECONDS', 120))
+held_leases = set()
+held_leases_lock = threading.Lock()
+# On SIGTERM or SIGINT no new study is started and the running ones get this
+# long to finish the prompts already sent before their leases are handed back
+SHUTDOWN_GRACE_SECONDS = float(os.environ.get('SHUTDOWN_GRACE_SECONDS', 25))
+stopping = threading.Event()
+# ResultBatch of every study in progress, flushed before a forced exit
+open_batches = set()
+open_batches_lock = threading.Lock()
+# Server error codes meaning change streams are unavailable (standalone mongod)
+CHANGE_STREAM_UNSUPPORTED = (40573, 40324)
+
+# Lease writes are updates too; only react to new or re-stamped logs
+LOG_EVENTS_PIPELINE = [{'$match': {'$or': [{'operationType': {'$in': ['insert', 'replace']}},
+                                           {'updateDescription.updatedFields.last_update': {'$exists': True}}]}}]
+# Prometheus text exposition on /metrics; 0 disables the endpoint. One-shot commands
+# serve it only when METRICS_PORT is set
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+def transcode_csv(raw_path, path):
+    # Encoding is guessed from a bounded sample, then the file is re-encoded chunk by chunk
+    with open(raw_path, 'rb') as f:
+        sample = f.read(ENCODING_SAMPLE_BYTES)
+    encoding = chardet.detect(sample)['encoding'] or 'utf-8'
+    if encoding.lower() == 'ascii':
+        encoding = 'utf-8'
+    for candidate, errors in ((encoding, 'strict'), ('cp1252', 'replace')):
+        try:
+            with open(raw_path, 'r', encoding=candidate, errors=errors, newline='') as src, \
+                    open(path, 'w', encoding='utf-8', newline='') as dst:
+                shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+            break
+        except (UnicodeDecodeError, LookupError):
+            continue
+    os.remove(raw_path)
+
+
+def save_object(file_obj, path, csv_file):
+    target = f"{path}.part" if csv_file else path
+    with metrics.stage('s3_download', path=path), open(target, 'wb') as f:
+        shutil.copyfileobj(file_obj["Body"], f, DOWNLOAD_CHUNK_SIZE)
+    metrics.s3_bytes.inc(file_obj.get("ContentLength", 0))
+    if csv_file:
+        transcode_csv(target, path)
+
+
+def list_study_files(study_id):
+    key = f"surveys/{study_id}/"
+    pages = iter(get_s3().get_paginator('list_objects_v2').paginate(Bucket=os.environ['BUCKET_NAME'], Prefix=key))
+    while True:
+        with metrics.stage('s3_list', study_id=study_id):
+            page = next(pages, None)
+        if page is None:
+            return
+        for item in page.get('Contents', []):
+            if item['Key'] != key:
+                yield item
 
-# AWS S3 setup
-s3 = boto3.client('s3',region_name='us-east-1',
-                  aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-                  aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
 
-# Generative AI setup
-genai.configure(api_key=os.environ['GEMINI_API_KEY'])
-model = genai.GenerativeModel('gemini-1.5-pro', generation_config={"response_mime_type": "text/plain"})
+def stage_object(file_key, etag, path, survey=False):
+    """Put `file_key` at `path`, reusing the staged copy when there is one.
 
-def download_files_from_s3(study_id):
-    key = f"surveys/{study_id}/"
-    objects = s3.list_objects_v2(Bucket=os.environ['BUCKET_NAME'], Prefix=key)
-    files = []
-    if 'Contents' in objects:
-        key_files = [item['Key'] for item in objects['Contents'] if item['Key'] != key]
-        if not os.path.exists(f"./storage/{study_id}/"):
-            os.makedirs(f"./storage/{study_id}/")
-        for file_key in key_files:
-            path = f"./storage/{study_id}/{file_key.split('/')[-1]}"
-            file_obj = s3.get_object(Bucket=os.environ['BUCKET_NAME'], Key=file_key)
-            if file_obj["ContentType"] == "application/pdf":
-                s3.download_file(os.environ['BUCKET_NAME'], file_key, path)
-                files.append(genai.upload_file(path))
-            elif file_obj["ContentType"] == "text/csv":
-                csv_body = file_obj["Body"].read()
-                result_encoding = chardet.detect(csv_body)
-                csv_content = csv_body.decode(result_encoding['encoding'])
-                with open(path, 'wb') as f:
-                    f.write(csv_content.encode('utf-8'))
-                files.append(genai.upload_file(path))
-            else:
-                pass
-    return files
-
-
-def perform_analysis(study_id, title, objectives, target, filter, files, modules, study_promt):
-
-    prompt_narrative = f"""
-        Entrevistamos a personas sobre el siguiente tema: "{str(title)}"
-        Objetivos de la encuesta: {str(objectives)}
-        Mercado del estudio: {str(target)}
-        Proposito de la encuesta: {str(study_promt)}
-        Hemos recolectado datos a través de una encuesta cuyo archivo principal de preguntas es el siguiente: log_{study_id}.csv. Usa los demás archivos relacionados para alimentar tu análisis y reforzar las conclusiones.
-
-        Por favor, realiza un análisis narrativo detallado de los datos que están en el archivo log_{study_id}.csv, CONSIDERA EL FILTRO DE: {str(filter)}. Proporciona un resumen bien estructurado, que incluya estadísticas exactas y ejemplos concretos de las respuestas de los encuestados. El análisis debe cubrir al menos los siguientes puntos:
-
-        1. Tendencias generales importantes:
-            - Proporciona una descripción detallada de las tendencias generales que encuentres en los datos.
-            - Incluye porcentajes y otras estadísticas relevantes calculadas a partir de los datos.
-
-        2. Diferencias significativas entre géneros:
-            - Analiza y describe cualquier diferencia significativa entre las respuestas de los géneros.
-            - Incluye estadísticas comparativas específicas para cada género.
-
-        3. Ejemplos concretos de respuestas:
-            - Incluye ejemplos textuales de respuestas de los encuestados que ilustren las tendencias y diferencias encontradas.
-            - Proporciona al menos dos ejemplos contrastantes de respuestas de los estudiantes.
-
-        4. Análisis de preguntas específicas:
-            - Selecciona al menos dos preguntas específicas del archivo CSV.
-            - Proporciona un análisis detallado de las respuestas a estas preguntas, incluyendo estadísticas relevantes.
-
-        5. Conclusión general:
-            - Resume los hallazgos principales del análisis.
-            - No introduzcas nueva información en esta sección.
-
-        Recuerda calcular y proporcionar todos los porcentajes y estadísticas exactas de acuerdo con los datos del archivo CSV. Utiliza los archivos adicionales para reforzar tus conclusiones y ejemplos y tambien usa un poco tu informacion de internet para agrandar mas tu analisis.
-
-        Formato de salida:
-        Devuelve un Markdown. El analisis análisis debe estar bien detallado y extenderse por un mínimo de tres párrafos grandes.
-        
-
-        EJEMPLO:
-        "
-        ## Análisis General de los Efectos de los Videojuegos en la Población Estudiantil de Tegucigalpa 
-        **Tendencias Generales Importantes:**
-        Un análisis de las respuestas obtenidas a través de la encuesta revela tendencias interesantes sobre los hábitos de consumo de videojuegos y sus efectos percibidos en la población estudiantil de Tegucigalpa. La mayoría de los encuestados (73%) afirma jugar videojuegos, lo cual indica una alta penetración de esta forma de entretenimiento entre los jóvenes. El tiempo dedicado a los videojuegos varía, siendo el rango más común de 1 a 3 horas diarias (41%). Los géneros de videojuegos preferidos son diversos, destacando los juegos de acción, RPG y casuales.  Un hallazgo importante es que la mayoría de los encuestados (60%) percibe efectos positivos en sus vidas gracias a los videojuegos. Entre los beneficios más mencionados se encuentran la mejora en las habilidades de concentración y resolución de problemas, así como un efecto relajante que ayuda a lidiar con el estrés.
-        "
-
-        **Diferencias Significativas Entre Géneros:**
-        información sobre las diferencias entre los géneros.
-        "
-        IMPORTANTE: ANALIZA TODAS LAS PREGUNTAS POSIBLES y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-        DEVUELVELO EN MARKDOWN.
-        
-        OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-        OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-        OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-        OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
+    Returns False for content types the model is not given; the survey is
+    always treated as CSV.
+    """
+    if get_staging().link(file_key, etag, path):
+        return True
+    file_obj = get_s3().get_object(Bucket=os.environ['BUCKET_NAME'], Key=file_key)
+    if not survey and file_obj["ContentType"] not in ("application/pdf", "text/csv"):
+        file_obj["Body"].close()
+        return False
+    save_object(file_obj, path, survey or file_obj["ContentType"] == "text/csv")
+    get_staging().add(file_key, etag, path)
+    return True
+
+
+def fetch_study_file(study_id, item, run_dir):
+    file_key = item['Key']
+    path = os.path.join(run_dir, file_key.split('/')[-1])
+
+    if file_key == f"surveys/{study_id}/log_{study_id}.csv":
+        # Parsed locally for the per-filter subsets, so fetched even when its upload is cached
+        stage_object(file_key, item['ETag'], path, survey=True)
+
+        def upload():
+            with metrics.stage('genai_upload', study_id=study_id, key=file_key):
+                return get_genai().upload_file(path)
+    else:
+        def upload():
+            if not stage_object(file_key, item['ETag'], path):
+                return None
+            with metrics.stage('genai_upload', study_id=study_id, key=file_key):
+                return get_genai().upload_file(path)
+
+    handle = file_cache.acquire((study_id, file_key, item['ETag']), upload)
+    if handle.file is None:
+        file_cache.release([handle])
+        return None
+    return handle
+
+
+def download_files_from_s3(study_id, run_dir):
+    handles = []
+    errors = []
+    # Each worker downloads then uploads, so uploads overlap with the remaining downloads
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(metrics.propagate(fetch_study_file), study_id, item, run_dir) for item in list_study_files(study_id)]
+        for future in as_completed(futures):
+            try:
+                handle = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if handle is not None:
+                handles.append(handle)
+    if errors:
+        file_cache.release(handles)
+        raise errors[0]
+    return sorted(handles, key=lambda handle: handle.key[1])
+
+
+def load_survey(study_id, run_dir):
+    path = os.path.join(run_dir, f"log_{study_id}.csv")
+    if not os.path.exists(path):
+        return None
+    try:
+        return SurveyData.load(path, f"log_{study_id}.csv", NPS_COLUMNS, SEGMENT_COLUMNS)
+    except (csv.Error, UnicodeDecodeError) as e:
+        logger.error(f"Error parsing survey for study {study_id}: {e}")
+        return None
+
+
+def upload_subset(study_id, survey_data, filter):
+    """Referenced upload of the rows `filter` selects, shared while those rows are unchanged."""
+    survey_key = f"surveys/{study_id}/log_{study_id}.csv"
+    digest = survey_data.digest(filter)
+
+    def upload():
+        path = os.path.join(os.path.dirname(survey_data.path), f"log_{study_id}_{digest[:16]}.csv")
+        survey_data.write_csv(filter, path)
+        with metrics.stage('genai_upload', study_id=study_id, key=survey_key):
+            return get_genai().upload_file(path)
+
+    # Keyed by filter, so a new upload of the same filter supersedes the old one
+    return file_cache.acquire((study_id, f"{survey_key}#{filter}", digest), upload)
+
+
+def filter_files(study_id, files, survey_file, survey_data, filter, uploads):
+    """Files and text parts sent for `filter`; subsets uploaded for it are appended to `uploads`."""
+    if survey_data is None:
+        return files
+    parts, subset, attach = survey_data.filter_parts(filter, SUBSET_INLINE_BYTES)
+    if subset:
+        # The filtered rows replace the full survey upload
+        files = [file for file in files if file is not survey_file]
+        if attach:
+            # Only uploads can be context cached, so large subsets are not resent with every prompt
+            handle = upload_subset(study_id, survey_data, filter)
+            uploads.append(handle)
+            files.append(handle.file)
+    return files + parts
+
+
+# S3 folder of each analysis under analysis/{study_id}/, in prompt order
+ANALYSIS_FOLDERS = {
+    "narrative": "general/narrative",
+    "factual": "general/factual",
+    "individual_narrative": "individual_questions/individual_narrative",
+    "percentage": "individual_questions/percentage",
+    "user_personas": "user_personas",
+    "segmentos": "psicographic_questions/segmentos",
+    "ekman": "psicographic_questions/ekman",
+    "nps": "psicographic_questions/nps",
+    "personality": "psicographic_questions/personality",
+    "estilo": "psicographic_questions/estilo",
+}
+
+
+def analysis_path(study_id, analysis, filter):
+    return f"analysis/{study_id}/{ANALYSIS_FOLDERS[analysis]}/{filter}.md"
+
+
+def result_hash(preamble, analysis, study_id, filter, files, etags):
+    # The template version stands in for the rendered prompt, the preamble
+    # carries the study metadata and inline parts the filtered survey data
+    digest = hashlib.sha256()
+    for part in [MODEL_NAME, get_prompts().version, preamble, analysis, study_id, filter, *sorted(etags),
+                 *[file for file in files if isinstance(file, str)]]:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def sent_etags(handles, files):
+    # Only the uploads a filter actually sends feed its result hashes
+    return [handle.key[2] for handle in handles if any(handle.file is file for file in files)]
+
+
+def context_digest(study_id, preamble, handles):
+    """Fingerprint of what every filter of a study shares.
+
+    Covers the model, the prompt templates, the study metadata in the
+    preamble and the files other than the survey, whose responses are
+    tracked per filter in the manifest.
     """
+    survey_key = f"surveys/{study_id}/log_{study_id}.csv"
+    digest = hashlib.sha256()
+    parts = [MODEL_NAME, preamble, get_prompts().version,
+             *sorted(handle.key[2] for handle in handles if handle.key[1] != survey_key)]
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
 
-    prompt_factual = f"""
-            Entrevistamos a personas sobre el siguiente tema: "{str(title)}"\n
-            Objetivos de la encuesta: {str(objectives)}\n
-            Mercado del estudio: {str(target)}\n
-            Proposito de la encuesta: {str(study_promt)}
-            El archivo principal de preguntas es el siguiente: log_{study_id}.csv, usa los demas archivos para alimentar tu data y las conclusiones de una mejor manera reforzando las respuesta con ella\n 
-            Haz un ANALISIS FACTUAL de el SIGUIENTE FILTRO: {str(filter)} detallando bien cada porcentaje, asegurate que la suma de los porcentajes cuadre y de como resultado 100.
-            EJEMPLO:
-            "
-            ## Análisis General de los Efectos de los Videojuegos en la Población Estudiantil de Tegucigalpa 
-            **Tendencias Generales Importantes:**
-            Un análisis de las respuestas obtenidas a través de la encuesta revela tendencias interesantes sobre los hábitos de consumo de videojuegos y sus efectos percibidos en la población estudiantil de Tegucigalpa. La mayoría de los encuestados (73%) afirma jugar videojuegos, lo cual indica una alta penetración de esta forma de entretenimiento entre los jóvenes. El tiempo dedicado a los videojuegos varía, siendo el rango más común de 1 a 3 horas diarias (41%). Los géneros de videojuegos preferidos son diversos, destacando los juegos de acción, RPG y casuales.  Un hallazgo importante es que la mayoría de los encuestados (60%) percibe efectos positivos en sus vidas gracias a los videojuegos. Entre los beneficios más mencionados se encuentran la mejora en las habilidades de concentración y resolución de problemas, así como un efecto relajante que ayuda a lidiar con el estrés.
-            "
-            IMPORTANTE: ANALIZA TODAS LAS PREGUNTAS POSIBLES y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-            DEVUELVELO EN MARKDOWN.
-            
-            OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-            OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-            OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-            OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
-        """
-
-    prompt_individual_questions = f"""
-    Entrevistamos a personas sobre el siguiente tema: "{str(title)}"
 
-    Objetivos de la encuesta: {str(objectives)}
-    Mercado del estudio: {str(target)}
-    Propósito de la encuesta: {str(study_promt)}
+def built_filters(manifest, context):
+    # Row digests the stored analyses were built from, while the shared context still matches
+    if manifest is None or manifest.get('context') != context:
+        return {}
+    return {entry['filter']: entry['rows'] for entry in manifest.get('filters', [])}
 
-    Con base en la información proporcionada en los archivos, hemos realizado entrevistas a profundidad con los encuestados.
-    Ahora tenemos que llegar a conclusiones concisas y basadas en hechos que ayuden a las partes interesadas de nuestra empresa a obtener información valiosa.
 
-    *Instrucciones:*
-    1. *Extrae y analiza todas las preguntas del archivo log_{study_id}.csv sin omitir ninguna.* 
-    2. *Enumera cada pregunta secuencialmente*, comenzando desde 1.
-    3. Para cada pregunta, sigue el estilo del ejemplo proporcionado. Cada conclusión debe tener 2-3 pensamientos relevantes de los encuestados y estar estructurada de la siguiente manera:
+def changed_filters(manifest, context, digests):
+    built = built_filters(manifest, context)
+    return [filter for filter, digest in digests.items() if built.get(filter) != digest]
 
-    *Formato de análisis para cada pregunta:*
-    1.  [Inserta la pregunta aquí]
-    
-    - Propósito de la pregunta: [Explica de manera detallada y larga  la pregunta de negocio relacionada con esta pregunta]
 
-    - Analisis: [Proporciona de manera detallada y larga el análisis narrativo de las respuestas de los encuestados en esta pregunta]
-    
-    - Conclusiones e insights:
-        - [Primer insight sobre las respuestas recolectadas]
-        - [Segundo insight sobre las respuestas recolectadas]
-        - [Tercer insight sobre las respuestas recolectadas]
+def manifest_update(manifest, context, digests, completed, responses):
+    built = built_filters(manifest, context)
+    built.update({filter: digests[filter] for filter in completed})
+    return {'$set': {'context': context, 'responses': responses, 'updated_at': datetime.now(),
+                     'filters': [{'filter': filter, 'rows': built[filter]} for filter in digests if filter in built]}}
 
-    *Recomendaciones para las partes interesadas:*
-    - [Recomendación 1]
-    - [Recomendación 2]
 
-    *Observación importante:*
-    Si, al aplicar los filtros ({str(filter)}), no hay datos suficientes para responder una o más preguntas, debes indicar claramente que "no se encontraron datos suficientes para realizar un análisis de esta pregunta debido a las restricciones de filtrado". OBLIGATORIO INDICAR TEXTUALMENTE QUE NO PUEDES ENCONTRAR DATOS SUFICIENTES A continuación, sugiere posibles ajustes al filtro o menciona cómo la falta de datos podría afectar las conclusiones del estudio.
+def build_preamble(study_id, title, objectives, target, study_promt):
+    # Shared by every prompt of a study, so it can live in a Gemini context cache
+    return f"""
+    Entrevistamos a personas sobre el siguiente tema: "{str(title)}"
+    Objetivos de la encuesta: {str(objectives)}
+    Mercado del estudio: {str(target)}
+    Proposito de la encuesta: {str(study_promt)}
+    El archivo principal de preguntas de la encuesta es log_{study_id}.csv. Usa los demás archivos relacionados para alimentar tu análisis y reforzar las conclusiones.
+    """
 
-    Toma como referencia este formato para cada pregunta. Asegúrate de:
-    - *Numerar y analizar todas las preguntas del archivo sin dejar ninguna.*
-    - Seguir la estructura de conclusiones con ejemplos claros.
-    - Evitar el conteo exacto de encuestados y no citar los IDs de las encuestas ni los nombres.
-    - Usar la primera letra en mayúscula para nombres propios.
-    - Devolver la información en formato Markdown.
 
-    El archivo principal de preguntas es: log_{study_id}.csv. Usa los otros archivos para complementar las respuestas.
+def build_prompts(study_id, filter):
+    return {analysis: get_prompts().render(analysis, study_id, filter) for analysis in ANALYSIS_FOLDERS}
 
-    Filtro aplicado: {str(filter)}
-    
-    
-    SIGUE EL SIGUIENTE FORMATO MARKDOWN:
-    # Título del Análisis - Título del Filtro
-    Enfoque
 
-    ---
+# Steps shared by this module and async_engine; they do no I/O of their own beyond local files
 
-    #### 1. Pregunta
-    Resumen
+def study_inputs(study_id, survey, study):
+    """Filters, General first, and prompt preamble of a study from its Surveys and Study documents.
 
-    ---
+    A missing or incomplete Surveys document leaves only the General filter.
+    """
+    filters = []
+    study_promt = None
+    try:
+        study_promt = survey['prompt']
+        filters = list(survey['filters'])
+    except (KeyError, TypeError):
+        pass
+    preamble = build_preamble(study_id, study['title'], study['studyObjectives'], study['marketTarget'], study_promt)
+    return ['General', *filters], preamble
 
-    #### 2. Pregunta
-    Resumen
-    ---
 
-    #### 3. Pregunta
-    Resumen
-    ---
+def study_context(preamble):
+    return StudyContext(get_model(), MODEL_NAME, GENERATION_CONFIG, preamble,
+                        CONTEXT_CACHE_TTL_SECONDS, CONTEXT_CACHE)
 
-    ## Análisis Final
-    Contenido del análisis final
+
+def plan_filters(study_id, filters, preamble, handles, survey_data, manifest):
+    """Filters whose inputs changed since `manifest`; returns (pending, shared digest, row digests)."""
+    digests = {filter: survey_data.digest(filter) for filter in filters}
+    shared = context_digest(study_id, preamble, handles)
+    pending = changed_filters(manifest, shared, digests)
+    logger.info("Filters to analyse", extra={'fields': {'study_id': study_id, 'changed': len(pending),
+                                                        'unchanged': len(digests) - len(pending)}})
+    return pending, shared, digests
+
+
+def filter_inputs(study_id, handles, survey_data, filters, uploads):
+    """(filter, files, etags) each of `filters` is analysed with.
+
+    Subsets uploaded on the way are appended to `uploads`, for the caller
+    to release once the study is done.
     """
+    files = [handle.file for handle in handles]
+    survey_file = next((handle.file for handle in handles if handle.key[1] == f"surveys/{study_id}/log_{study_id}.csv"), None)
+    for filter in filters:
+        filtered = filter_files(study_id, files, survey_file, survey_data, filter, uploads)
+        yield filter, filtered, sent_etags(handles + uploads, filtered)
 
-    prompt_percentage_questions = f"""
-    Entrevistamos a personas sobre el siguiente tema: "{str(title)}"
 
-    Objetivos de la encuesta: {str(objectives)}
-    Mercado del estudio: {str(target)}
-    Propósito de la encuesta: {str(study_promt)}
+def analysis_plan(study_id, filter, files, etags, preamble):
+    """Prompt, output path and input hash of every analysis of a filter."""
+    prompts = build_prompts(study_id, filter)
+    paths = {key: analysis_path(study_id, key, filter) for key in prompts}
+    hashes = {key: result_hash(preamble, key, study_id, filter, files, etags) for key in prompts}
+    return prompts, paths, hashes
 
-    **Instrucciones:**
-    1. **Haz un análisis porcentual por cada pregunta**, asegurándote de intentar el análisis aun cuando la cantidad de datos sea baja. Siempre que sea posible, intenta estimar los porcentajes.
-    2. **Enumera todas las preguntas del archivo** sin omitir ninguna, incluso si no tienen suficientes datos para un análisis completo.
-    3. Si realmente no se puede realizar el análisis porcentual de una pregunta debido al filtro aplicado, **indica claramente: "No se encontraron datos suficientes para realizar un análisis de esta pregunta debido a las restricciones de filtrado."**
 
-    **Ejemplo del formato de análisis porcentual:**
-    "
-    1. ¿Con qué frecuencia visitas el restaurante de alitas?
-        - Diariamente: 5%
-        - Semanalmente: 25%
-        - Mensualmente: 45%
-        - Raramente: 25%
+def filter_priority(filter):
+    # The General filter is scheduled ahead of the rest
+    return 0 if filter == 'General' else 1
 
-    2. ¿Con qué frecuencia haces ejercicio?
-        No se encontraron datos suficientes para realizar un análisis de esta pregunta debido a las restricciones de filtrado.
-    "
 
-    **Formato que debes seguir para el análisis:**
-    # Título del Análisis - Título del Filtro
-    Enfoque
+def finish_study(study_id, filters, pending, completed, interrupted):
+    """Raise StudyInterrupted if stopping left filters pending, otherwise record the study as processed."""
+    if interrupted and len(completed) < len(pending):
+        # The log stays in survey_logs; the next run skips the analyses already saved
+        raise StudyInterrupted(f"Study {study_id} stopped with {len(pending) - len(completed)} filters pending")
+    logger.info("Study processed", extra={'fields': {'study_id': study_id, 'filters': len(filters)}})
+    with open("logs.txt", "a") as f:
+        f.write(f"Study {study_id} processed at {datetime.now()}\n")
 
-    ---
 
-    #### *1. Pregunta*
-    - Opción uno: porcentaje%
+def stream_prompt(prompt_model, contents, path, meta):
+    """Generate with streaming, exposing partial text in analysis_progress.
 
-    ---
+    The S3 object only appears once generation completes: short responses
+    are written with one put_object, long ones through a multipart upload
+    that is completed at the end and aborted on failure. Returns the
+    response and the ETag of the written object.
+    """
+    progress = get_db()['analysis_progress']
+    progress.update_one({'_id': path}, start_progress(meta, datetime.now()), upsert=True)
+    stream = StreamBuffer(STREAM_PART_SIZE, STREAM_PROGRESS_SECONDS)
+    upload_id = None
 
-    #### *2. Pregunta*
-    - Opción uno: porcentaje%
+    def upload_part():
+        part_number = stream.next_part_number()
+        stream.add_part(get_s3().upload_part(Bucket=os.environ['BUCKET_NAME'], Key=path, UploadId=upload_id,
+                                             PartNumber=part_number, Body=stream.take_part())['ETag'])
 
-    ---
+    try:
+        response = prompt_model.generate_content(contents, stream=True)
+        for chunk in response:
+            stream.add(chunk.text)
+            if stream.full_part():
+                if upload_id is None:
+                    upload_id = get_s3().create_multipart_upload(Bucket=os.environ['BUCKET_NAME'], Key=path)['UploadId']
+                upload_part()
+            delta = stream.take_delta()
+            if delta:
+                progress.update_one({'_id': path}, append_progress(delta, datetime.now()))
+        if upload_id is None:
+            etag = get_s3().put_object(Bucket=os.environ['BUCKET_NAME'], Key=path, Body=stream.take_part())['ETag']
+        else:
+            if stream.buffer:
+                upload_part()
+            etag = get_s3().complete_multipart_upload(Bucket=os.environ['BUCKET_NAME'], Key=path, UploadId=upload_id,
+                                                      MultipartUpload={'Parts': stream.parts})['ETag']
+        delta = stream.take_delta(force=True)
+        if delta:
+            progress.update_one({'_id': path}, append_progress(delta, datetime.now()))
+        progress.update_one({'_id': path}, end_progress('done', datetime.now()))
+        return response, etag
+    except BaseException:
+        if upload_id is not None:
+            get_s3().abort_multipart_upload(Bucket=os.environ['BUCKET_NAME'], Key=path, UploadId=upload_id)
+        progress.update_one({'_id': path}, end_progress('failed', datetime.now()))
+        raise
+
+
+def indexed_hashes(collection, paths):
+    # An output only counts as stored once indexed, so its analysis_results row is the cache entry
+    return {doc['_id']: doc.get('input_hash') for doc in collection.find({'_id': {'$in': list(paths.values())}},
+                                                                        {'input_hash': 1})}
+
+
+def pending_prompts(prompts, paths, hashes, cached):
+    # Analyses whose stored result was built from different inputs
+    return {key: prompt for key, prompt in prompts.items() if cached.get(paths[key]) != hashes[key]}
+
+
+def plan_groups(prompts):
+    """Split pending analyses into multi-section groups and single prompts."""
+    groups = []
+    for group in PROMPT_GROUPS:
+        keys = [key for key in group if key in prompts]
+        if len(keys) > 1:
+            groups.append(keys)
+    grouped = {key for keys in groups for key in keys}
+    return groups, [key for key in prompts if key not in grouped]
+
+
+def build_group_prompt(prompts, keys):
+    sections = "\n".join(f"<<<SECCION: {key}>>>\n{prompts[key]}" for key in keys)
+    return f"""
+    Vas a realizar {len(keys)} análisis independientes sobre los mismos archivos.
+    Responde cada análisis en su propia sección, en el mismo orden, empezando cada una con una línea que diga exactamente <<<SECCION: nombre>>> usando el nombre indicado.
+    No escribas nada fuera de las secciones. Cada sección debe cumplir todas las instrucciones de su análisis.
+    {sections}
+    """
 
-    #### *3. Pregunta*
-    - Opción uno: porcentaje%
 
-    ---
+def split_sections(text, keys):
+    """Markdown per analysis from a multi-section response; incomplete sections are left out."""
+    sections = {}
+    headers = list(SECTION_HEADER.finditer(text))
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        body = text[header.end():end].strip()
+        if header.group(1) in keys and body:
+            sections[header.group(1)] = body
+    return sections
 
-    ## Análisis Final
-    Contenido del análisis final
 
-    **Obligatorio:**
-    - **Numerar y analizar todas las preguntas del archivo log_{study_id}.csv sin dejar ninguna**, aunque no haya suficientes datos.
-    - **No mostrar conteo de encuestados**; solo mostrar el porcentaje en formato (porcentaje%).
-    - La primera letra de los nombres propios debe ir en mayúscula.
-    - Usa títulos, subtítulos y separaciones claras entre cada análisis.
-    - El análisis debe devolverse en formato Markdown.
+def perform_analysis(study_id, filter, files, etags, context, batch):
+    prompts, paths, hashes = analysis_plan(study_id, filter, files, etags, context.preamble)
+    if RESULT_CACHE:
+        prompts = pending_prompts(prompts, paths, hashes, indexed_hashes(get_results(), paths))
 
-    El archivo principal de preguntas es: log_{study_id}.csv. Usa los demás archivos para complementar tu análisis.
-    """
+    def describe(analysis, request, response, seconds):
+        return lambda etag: result_update(study_id, filter, analysis, paths[analysis], etag, request, response,
+                                          seconds, hashes[analysis])
 
+    # Uploads run on the persistence pool; the model slot is released meanwhile
+    writes = {}
 
-    prompt_nps_questions = f"""
-        Entrevistamos a personas sobre el siguiente tema: "{str(title)}"\n
-        Objetivos de la encuesta: {str(objectives)}\n
-        Mercado del estudio: {str(target)}\n
-        Proposito de la encuesta: {str(study_promt)}
-        Haz un ANALISIS PORCENTUAL y NPS por pregunta sin detallar o explicar cosas, SACA LA INFORMACION DEL SIGUIENTE FILTRO: {str(filter)}\n
-        En el mismo formato agregale la Clasificacion NPS a cada porcentaje
-            Clasificación NPS:
-                Promotores (P): Calificaciones de 9-10. Clientes extremadamente satisfechos y leales, que recomendarían activamente el restaurante.
-                Indiferentes (I): Calificaciones de 7-8. Clientes satisfechos pero no entusiastas, que podrían cambiar a la competencia.
-                Detractores (D): Calificaciones de 0-6. Clientes insatisfechos que podrían desaconsejar a otros de visitar el restaurante.
-            
-            Ejemplo:
-                "
-                1. ¿Con qué frecuencia visitas el restaurante de alitas?
-                    Diariamente: 5% (P)
-                    Semanalmente: 25% (P)
-                    Mensualmente: 45% (I)
-                    Raramente: 25% (D)
-                "
-        IMPORTANTE: ANALIZA TODAS LA INFORMACION y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-        DEVUELVELO EN MARKDOWN.
-
-        OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-        OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-        OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-        OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
-        """
-
-    prompt_ekman_questions = f"""
-            Entrevistamos a personas sobre el siguiente tema: "{str(title)}"\n
-            Objetivos de la encuesta: {str(objectives)}\n
-            Mercado del estudio: {str(target)}\n
-            SACA LA INFO DEL SIGUIENTE FILTRO: {str(filter)}\n
-            Proposito de la encuesta: {str(study_promt)}
-            Haz un Analisis de emosiones EKMAN dde cada pregunta, combina siguiendo el siguiente ejemplo:
-            
-            "¿Con qué frecuencia visitas el restaurante de alitas?
-                Alegría (40%): Clientes que visitan semanalmente (25%) y diariamente (5%) experimentan alegría y satisfacción.
-                Sorpresa (10%): Visitas raras (25%) que ocurren en ocasiones especiales pueden estar asociadas con sorpresa.
-                Enojo/Tristeza (5%): Visitas raras (25%) debido a malas experiencias previas podrían generar enojo o tristeza.
-                Miedo (0%): No se observaron respuestas asociadas con miedo.
-                Disgusto (0%): No se observaron respuestas asociadas con disgusto.
-            "
-            
-            IMPORTANTE: ANALIZA TODAS LAS PREGUNTAS POSIBLES y DEVUELVE EN MARKDOWN, SACA LA INFO DEL SIGUIENTE FILTRO: {str(filter)}\n
-            
-            El archivo principal de preguntas es el siguiente: log_{study_id}.csv, usa los demas archivos para alimentar tu data y las conclusiones de una mejor manera reforzando las respuesta con ella\n 
-            
-            DEVUELVELO EN MARKDOWN.
-            
-            OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-            OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-            OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-            OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
-        """    
-
-    prompt_personality_questions = f"""
-            Entrevistamos a personas sobre el siguiente tema: "{str(title)}"\n
-            Objetivos de la encuesta: {str(objectives)}\n
-            Mercado del estudio: {str(target)}\n
-            Proposito de la encuesta: {str(study_promt)}
-            Haz un analisis de Rasgos de personalidad de cada pregunta, combina siguiendo el siguiente ejemplo:
-            "¿Con qué frecuencia visitas el restaurante de alitas?
-                Emocionales (30%):
-                Semanalmente (25%) y Diariamente (5%): Estos clientes probablemente visitan el restaurante frecuentemente debido a una fuerte conexión emocional con la experiencia, disfrutando de la atmósfera, el sabor y las emociones positivas que asocian con el lugar.
-                Racionales (70%):
-                Mensualmente (45%) y Raramente (25%): Estos clientes planifican sus visitas con menos frecuencia, probablemente basando su decisión en factores racionales como presupuesto, conveniencia o eventos especiales."
-            IMPORTANTE: ANALIZA TODAS LAS PREGUNTAS POSIBLES  y elimina los caracteres de escape raros o especiales como \\xa0 que pueden molestar el json
-            
-            El archivo principal de preguntas es el siguiente: log_{study_id}.csv, usa los demas archivos para alimentar tu data y las conclusiones de una mejor manera reforzando las respuesta con ella\n 
-            
-            IMPORTANTE: ANALIZA TODAS LAS PREGUNTAS POSIBLES y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-            DEVUELVELO EN MARKDOWN.
-
-            OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-            OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-            OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-            OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
-        """
-        
-    prompt_segmentos_questions = f"""
-            Entrevistamos a personas sobre el siguiente tema: "{str(title)}"\n
-            Objetivos de la encuesta: {str(objectives)}\n
-            Mercado del estudio: {str(target)}\n
-            Proposito de la encuesta: {str(study_promt)}
-            Con base en la información proporcionada en los archivos, hemos realizado entrevistas a profundidad con los encuestados.
-            Ahora tenemos que llegar a conclusiones concisas y basadas en hechos que ayuden a las partes interesadas de nuestra empresa a obtener información valiosa.
-            Haz un analisis de los segmentos psicograficos de los encuestados, combina siguiendo el siguiente ejemplo:
-            "
-            ¿Cuál es tu sabor de alitas favorito?
-                Embajadores (30%): Preferencia por picante (30%) sugiere clientes que son apasionados y pueden recomendar el restaurante a otros.
-                Leales (25%): Preferencia por agridulce (25%) indica una satisfacción constante y una fuerte preferencia por ciertos sabores.
-                Indistintos (20%): Preferencia por barbacoa (20%) sugiere una satisfacción general sin una fuerte inclinación.
-                Críticos (15%): Preferencia por búfalo (15%) puede indicar que disfrutan de la oferta pero no están totalmente satisfechos.
-                En Riesgo (10%): Preferencia por limón y pimienta (10%) puede representar a aquellos que buscan opciones específicas y podrían cambiar si no las encuentran.
-            "
-            
-            IMPORTANTE: ANALIZA TODAS LAS PREGUNTAS POSIBLES y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-            
-            El archivo principal de preguntas es el siguiente: log_{study_id}.csv, usa los demas archivos para alimentar tu data y las conclusiones de una mejor manera reforzando las respuesta con ella\n 
-            
-            DEVUELVE EL ANALISIS EN MARKDOWN.
-            
-            OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-            OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-            OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-            OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
-        """        
-            
-    promptestilo_comunicacion_questions = f"""
-            Entrevistamos a personas sobre el siguiente tema: "{str(title)}"\n
-            Objetivos de la encuesta: {str(objectives)}\n
-            Mercado del estudio: {str(target)}\n
-            Proposito de la encuesta: {str(study_promt)}
-            Con base en la información proporcionada en los archivos, hemos realizado entrevistas a profundidad con los encuestados.
-            Ahora tenemos que llegar a conclusiones concisas y basadas en hechos que ayuden a las partes interesadas de nuestra empresa a obtener información valiosa.
-            Haz un analisis de los Estilos de Comunicacion de los encuestados, combina siguiendo el siguiente ejemplo:
-            
-            Segmentación por Estilo de Comunicación:
-            Para categorizar a los encuestados según su estilo de comunicación (Reveladores, Factuales, Informativos, Buscador de Acción), se utilizarán respuestas inventadas y segmentaciones basadas en como los encuestados expresan sus opiniones y preferencias.
-            
-            IMPORTANTE: ANALIZA TODAS LAS PREGUNTAS POSIBLES y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-
-            EJEMPLO:
-            "
-            Análisis de los Resultados de la Encuesta:
-                ¿Con qué frecuencia visitas el restaurante de alitas?
-                    Reveladores: 15%
-                    Factuales: 35%
-                    Informativos: 30%
-                    Buscador de Acción: 20%
-            "
-                    
-            IMPORTANTE: ANALIZA TODAS LA INFORMACION y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-            DEVUELVELO EN MARKDOWN.
-            
-            OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-            OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-            OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-            OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
-        """
-    
-    prompt_user_personas = f"""
-            Entrevistamos a personas sobre el siguiente tema: "{str(title)}"
-            Objetivos de la encuesta: {str(objectives)}
-            Mercado del estudio: {str(target)}
-            Proposito de la encuesta: {str(study_promt)}
-            Hemos recolectado datos a través de una encuesta cuyo archivo principal de preguntas es el siguiente: log_{study_id}.csv. Usa los demás archivos relacionados para alimentar tu análisis y reforzar las conclusiones.
-            HAZ UN USUARIO Y DESCRIBE UN COMUN PARA ESTE ESTUDIO DE ACUERDO AL SIGUIENTE FILTRO: {filter}
-            Formato de salida:
-            Devuelvelo en MARKDOWN. Cada análisis debe estar bien detallado y extenderse por un mínimo de tres párrafos grandes.
-            
-            USA EL SIGUIENTE EJEMPLO PARA QUE TU ANALISIS SEA CORRECTO:
-            "
-                Nombre: Juan Pérez
-
-                Demografía:
-                Edad: 28 años
-                Género: Masculino
-                Nivel de Ingresos: $30,000 - $50,000 anuales
-                Ocupación: Profesional de TI
-                Estado Civil: Soltero
-                
-                Psicografía:
-                Intereses y Aficiones: Deportes, videojuegos, salir con amigos
-                Valores y Creencias: Valora la autenticidad y la calidad en los alimentos
-                Estilo de Vida: Activo, social, disfruta de la vida nocturna
-                Personalidad: Extrovertido, aventurero, le gusta probar cosas nuevas
-                
-                Comportamiento:
-                Patrones de Compra: Visita el restaurante al menos una vez al mes, más frecuente durante eventos deportivos
-                Lealtad a la Marca: Fiel al restaurante por sus sabores únicos y buen servicio
-                Motivaciones de Compra: Busca una experiencia divertida y sabores intensos
-                Canales de Compra Preferidos: Prefiere comer en el restaurante para disfrutar del ambiente
-                
-                Necesidades y Puntos de Dolor:
-                Necesidades: Variedad de sabores, ambiente animado, opciones para ver deportes en vivo
-                Puntos de Dolor: A veces, la espera es demasiado larga durante horas pico
-                
-                Preferencias y Hábitos de Consumo:
-                Preferencias de Producto: Sabores picantes y agridulces
-                Preferencias de Servicio: Valora un servicio rápido y amable
-                Hábitos de Consumo: Visita más frecuentemente los fines de semana y durante eventos deportivos
-                
-                Competencia:
-                Percepción de la Competencia: Considera que otros restaurantes no tienen tanta variedad de sabores            
-            "
-            
-            USA SUBTITULOS Y TITULOS EN TU ANALISIS USANDO EL FORMATO MARKDOWN
-            IMPORTANTE: ANALIZA TODAS LA INFORMACION y DEVUELVE EN MARKDOWN, SACA LA TODA INFORMCION CON RESPETO AL SIGUIENTE FILTRO: {str(filter)}\n
-            DEVUELVELO EN MARKDOWN.
-            
-            OBLIGATORIO : NO MUESTRES EL CONTEO DE ENCUESTADOS EN NINGUN MOMENTO, SOLO ANALIZA Y PORCENTUALIZA
-            OBLIGATORIO : LA PRIMERA LETRA DE LOS NOMBRES PROPIOS TIENE QUE IR EN MAYUSCULA
-            OBLIGATORIO : NO CITAR LOS ID'S DE LAS ENCUESTAS NI LOS NOMBRES DE LOS ENCUESTADOS, SOLO INSERTAR LA CITA
-            OBLIGATORIO : NO CITAR EL DOCUMENTO EN EL QUE SE BASA EL ANALISIS
-        """
-    prompts = {
-        "narrative": prompt_narrative,
-        "factual": prompt_factual,
-        "individual_narrative": prompt_individual_questions,
-        "percentage": prompt_percentage_questions,
-        "user_personas": prompt_user_personas,
-        "segmentos": prompt_segmentos_questions,
-        "ekman": prompt_ekman_questions,
-        "nps": prompt_nps_questions,
-        "personality" : prompt_personality_questions,
-        "estilo" : promptestilo_comunicacion_questions
-    }
-        
-    def process_prompt(prompt, analysis):
-        flag = True
-        while flag:
-            try:
-                response = model.generate_content(files + [prompt])
-                md_response = response.text
-                path = f"analysis/{study_id}/"
-                if(analysis == "factual" or analysis == "narrative"):
-                    path += f"general/{analysis}/{filter}.md"
-                elif(analysis == "individual_narrative" or analysis == "percentage"):
-                    path += f"individual_questions/{analysis}/{filter}.md"
-                elif(analysis == "user_personas"):
-                    path += f"user_personas/{filter}.md"
-                elif(analysis == "segmentos" or analysis == "ekman" or analysis == "nps" or analysis == "personality" or analysis == "estilo"):
-                    path += f"psicographic_questions/{analysis}/{filter}.md"
-                s3.put_object(Bucket=os.environ['BUCKET_NAME'], Key=path, Body=md_response)
-                flag = False
-            except Exception as e:
-                flag = True
-                print(f"Error processing prompt: {e}")
+    def save_result(analysis, md_response, describe_result):
+        writes[batch.put(paths[analysis], md_response, describe_result, {'analysis': analysis})] = analysis
 
-    with ThreadPoolExecutor() as executor:
-        future_to_prompt = {executor.submit(process_prompt, prompt, key): key for key, prompt in prompts.items()}
-        for future in as_completed(future_to_prompt):
-            key = future_to_prompt[future]
+    def process_prompt(prompt, analysis):
+        prompt_model, contents = context.prepare(files, prompt)
+        started = time.perf_counter()
+        if STREAM_GENERATION:
+            with metrics.stage('generate', {'analysis': analysis}, study_id=study_id, filter=filter):
+                response, etag = stream_prompt(prompt_model, contents, paths[analysis],
+                                               {'study_id': study_id, 'filter': filter, 'analysis': analysis})
+            metrics.record_usage(response, analysis)
+            batch.add(describe(analysis, analysis, response, time.perf_counter() - started)(etag))
+        else:
+            with metrics.stage('generate', {'analysis': analysis}, study_id=study_id, filter=filter):
+                response = prompt_model.generate_content(contents)
+            metrics.record_usage(response, analysis)
+            save_result(analysis, response.text, describe(analysis, analysis, response, time.perf_counter() - started))
+        return response
+
+    missing = {}
+
+    def process_group(keys):
+        prompt_model, contents = context.prepare(files, build_group_prompt(prompts, keys))
+        started = time.perf_counter()
+        with metrics.stage('generate', {'analysis': '+'.join(keys)}, study_id=study_id, filter=filter):
+            response = prompt_model.generate_content(contents)
+        seconds = time.perf_counter() - started
+        metrics.record_usage(response, '+'.join(keys))
+        sections = split_sections(response.text, keys)
+        for key, md_response in sections.items():
+            save_result(key, md_response, describe(key, '+'.join(keys), response, seconds))
+        missing[tuple(keys)] = [key for key in keys if key not in sections]
+        return response
+
+    priority = filter_priority(filter)
+
+    def submit_prompt(key):
+        return get_scheduler().submit(metrics.propagate(process_prompt), prompts[key], key, priority=priority,
+                                      group=study_id, meta={'study_id': study_id, 'filter': filter, 'analysis': key})
+
+    groups, singles = plan_groups(prompts)
+    failed = []
+    future_to_prompt = {submit_prompt(key): [key] for key in singles}
+    for keys in groups:
+        future = get_scheduler().submit(metrics.propagate(process_group), keys, priority=priority, group=study_id,
+                                        meta={'study_id': study_id, 'filter': filter, 'analysis': '+'.join(keys)})
+        future_to_prompt[future] = keys
+    while future_to_prompt:
+        done, _ = wait(future_to_prompt, return_when=FIRST_COMPLETED)
+        for future in done:
+            keys = future_to_prompt.pop(future)
             try:
                 future.result()
+            except SchedulerClosed:
+                # Not sent before shutdown
+                failed.extend(keys)
+                continue
             except Exception as e:
-                print(f"Error retrieving result for {key}: {e}")
+                logger.error(f"Error retrieving result for {'+'.join(keys)}: {e}")
+                fallback = keys if len(keys) > 1 else []
+                if len(keys) == 1:
+                    failed.extend(keys)
+            else:
+                fallback = missing.get(tuple(keys), [])
+            # Sections the grouped response failed or garbled are asked for one by one
+            for key in fallback:
+                future_to_prompt[submit_prompt(key)] = [key]
+    for future in list(writes):
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Error saving result for {writes[future]}: {e}")
+            failed.append(writes[future])
+    return failed
+
+def analyze_filter(study_id, filter, files, etags, context, batch):
+    with metrics.stage('filter', study_id=study_id, filter=filter):
+        return perform_analysis(study_id, filter, files, etags, context, batch)
+
+def analyze_study(study_id, filters, preamble, handles, survey_data):
+    """Analyse the filters of a study whose inputs changed; returns (pending, completed) filters."""
+    completed = []
+    batch = ResultBatch(study_id, get_s3(), os.environ['BUCKET_NAME'], get_persist_executor(), get_results(),
+                        RESULT_FLUSH_SIZE, RESULT_FLUSH_SECONDS)
+    with open_batches_lock:
+        open_batches.add(batch)
+    context = study_context(preamble)
+    uploads = []
+    try:
+        incremental = INCREMENTAL_ANALYSIS and survey_data is not None
+        pending = filters
+        if incremental:
+            manifest = get_db()['analysis_manifests'].find_one({'_id': ObjectId(study_id)})
+            pending, shared, digests = plan_filters(study_id, filters, preamble, handles, survey_data, manifest)
+        with ThreadPoolExecutor() as executor:
+            futures = {executor.submit(metrics.propagate(analyze_filter), study_id, filter, files, etags, context,
+                                       batch): filter
+                       for filter, files, etags in filter_inputs(study_id, handles, survey_data, pending, uploads)}
+            for future in as_completed(futures):
+                try:
+                    if not future.result():
+                        completed.append(futures[future])
+                except Exception as e:
+                    logger.error(f"Error processing analysis: {e}")
+    finally:
+        context.close()
+        file_cache.release(uploads)
+        with open_batches_lock:
+            open_batches.discard(batch)
+        # Unindexed outputs are regenerated, so a failed write fails the study and its log is retried
+        batch.flush()
+    if incremental:
+        # Filters with failed analyses keep their old entry, so the next run retries them
+        get_db()['analysis_manifests'].update_one({'_id': ObjectId(study_id)},
+                                                  manifest_update(manifest, shared, digests, completed, len(survey_data)),
+                                                  upsert=True)
+    return pending, completed
+
+class StudyInterrupted(Exception):
+    """The process is stopping before the study could be completed."""
 
-    for file in files:
-        file.delete()
 
 def process_log(log):
     study_id = str(log['_id'])
     last_updated = log['last_update']
     # Get filters from Surveys collection
-    if (datetime.now() - last_updated).seconds < 60:
-        return
-    filters = []
-    modules = []
     try:
-        survey = db['Surveys'].find_one({'_id': ObjectId(study_id)})
-        study_promt = survey['prompt']
-        filters = survey['filters']
-    except Exception as e:
-        pass
-    filters.insert(0, 'General')
-
+        with metrics.stage('mongo_lookup', {'collection': 'Surveys'}, study_id=study_id):
+            survey = get_db()['Surveys'].find_one({'_id': ObjectId(study_id)})
+    except PyMongoError:
+        survey = None
     # Get study details from Study collection
-    study = db['Study'].find_one({'_id': ObjectId(study_id)})
-    title = study['title']
-    objectives = study['studyObjectives']
-    target = study['marketTarget']
-    files = download_files_from_s3(study_id)
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(perform_analysis, study_id, title, objectives, target, filter, files, modules, study_promt) for filter in filters]
+    with metrics.stage('mongo_lookup', {'collection': 'Study'}, study_id=study_id):
+        study = get_db()['Study'].find_one({'_id': ObjectId(study_id)})
+    filters, preamble = study_inputs(study_id, survey, study)
+    # Local copies stay until the study ends: filters read their rows back from the survey file
+    with get_staging().run(study_id) as run_dir:
+        handles = download_files_from_s3(study_id, run_dir)
+        survey_data = None
+        try:
+            survey_data = load_survey(study_id, run_dir)
+            pending, completed = analyze_study(study_id, filters, preamble, handles, survey_data)
+        finally:
+            # Uploaded files stay cached for later runs until evicted
+            file_cache.release(handles)
+            if survey_data is not None:
+                survey_data.close()
+    finish_study(study_id, filters, pending, completed, stopping.is_set())
+    get_db()['survey_logs'].delete_one({'_id': ObjectId(study_id), 'last_update': last_updated, 'lease_owner': WORKER_ID})
+
+class LogQueue:
+    """Debounced, prioritised queue of survey_logs documents.
+
+    A study is handed to a worker once its log has been quiet for `debounce`
+    seconds, holds at most one pending entry, and is never processed by two
+    workers at the same time. Among due studies the earliest virtual
+    deadline goes first: the moment the study became due, pushed back for
+    large studies by `size_weight` seconds per doubling of its estimated
+    `work` (at most `size_penalty`) and brought forward by `priority_boost`
+    seconds per point of the log's `priority` field. Large studies yield to
+    small ones for a bounded time, so neither starves.
+    """
+
+    def __init__(self, debounce, size_weight=0.0, size_penalty=0.0, priority_boost=0.0):
+        self.debounce = debounce
+        self.size_weight = size_weight
+        self.size_penalty = size_penalty
+        self.priority_boost = priority_boost
+        self.cond = threading.Condition()
+        self.heap = []
+        self.ready = []
+        self.pending = {}
+        self.due = {}
+        self.latest = {}
+        self.work = {}
+        self.running = set()
+
+    def _schedule(self, study_id, log, due):
+        self.pending[study_id] = log
+        self.due[study_id] = due
+        heapq.heappush(self.heap, (due, study_id))
+        self._wake()
+
+    def needs_work(self, log):
+        """Whether `log` would open a new pending entry, whose size should be estimated."""
+        study_id = str(log['_id'])
+        with self.cond:
+            latest = self.latest.get(study_id)
+            return (latest is None or latest < log['last_update']) and study_id not in self.pending
+
+    def push(self, log, work=None):
+        study_id = str(log['_id'])
+        with self.cond:
+            latest = self.latest.get(study_id)
+            if latest is not None and latest >= log['last_update']:
+                return False
+            self.latest[study_id] = log['last_update']
+            if work is not None:
+                self.work[study_id] = work
+            elapsed = (datetime.now() - log['last_update']).total_seconds()
+            self._schedule(study_id, log, time.monotonic() + max(0.0, self.debounce - elapsed))
+            return True
+
+    def retry(self, log, delay):
+        study_id = str(log['_id'])
+        with self.cond:
+            if study_id not in self.pending:
+                self._schedule(study_id, log, time.monotonic() + delay)
+
+    def _wake(self):
+        self.cond.notify_all()
+
+    def _deadline(self, study_id, due):
+        priority = self.pending[study_id].get('priority') or 0
+        if not isinstance(priority, (int, float)):
+            priority = 0
+        penalty = min(self.size_penalty, self.size_weight * math.log2(max(self.work.get(study_id, 1), 1)))
+        return due + penalty - self.priority_boost * priority
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    def take(self):
+        """Next due log, or None and the seconds until one may become due."""
+        with self.cond:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                due, study_id = heapq.heappop(self.heap)
+                # Stale entry: superseded by a newer log
+                if self.due.get(study_id) == due:
+                    heapq.heappush(self.ready, (self._deadline(study_id, due), due, study_id))
+            while self.ready:
+                _, due, study_id = heapq.heappop(self.ready)
+                # Stale entry, or the study is running and `done` will schedule it again
+                if self.due.get(study_id) != due or study_id in self.running:
+                    continue
+                del self.due[study_id]
+                self.running.add(study_id)
+                metrics.study_wait.observe(now - due)
+                return self.pending.pop(study_id), None
+            return None, (self.heap[0][0] - now if self.heap else None)
+
+    def pop(self):
+        with self.cond:
+            while True:
+                log, timeout = self.take()
+                if log is not None:
+                    return log
+                self.cond.wait(timeout)
+
+    def done(self, log):
+        study_id = str(log['_id'])
+        with self.cond:
+            self.running.discard(study_id)
+            if study_id in self.pending:
+                heapq.heappush(self.heap, (self.due[study_id], study_id))
+                self._wake()
+            else:
+                # Nothing left to run: a log seen again later just starts a new entry
+                self.latest.pop(study_id, None)
+                self.work.pop(study_id, None)
+
+
+def study_work(filters, total_bytes):
+    # Every filter (plus General) sends its prompts over all of the study's files
+    return (filters + 1) * (1 + total_bytes / (1024 * 1024))
+
+
+def estimate_work(study_id):
+    survey = get_db()['Surveys'].find_one({'_id': ObjectId(study_id)}, {'filters': 1}) or {}
+    return study_work(len(survey.get('filters') or []), sum(item['Size'] for item in list_study_files(study_id)))
+
+
+def enqueue(log_queue, log):
+    work = None
+    if log_queue.needs_work(log):
+        try:
+            work = estimate_work(str(log['_id']))
+        except Exception as e:
+            logger.warning(f"Could not estimate the size of study {log['_id']}: {e}")
+    return log_queue.push(log, work)
+
+
+# survey_logs filters and updates of the leases, shared with async_engine
+def lease_claim(log_id):
+    # Free logs and logs whose holder stopped renewing
+    now = datetime.now()
+    return ({'_id': log_id, '$or': [{'lease_owner': None}, {'lease_expires': {'$lt': now}}]},
+            {'$set': {'lease_owner': WORKER_ID, 'lease_expires': now + timedelta(seconds=LEASE_SECONDS)}})
+
+
+def lease_renewal(ids):
+    return ({'_id': {'$in': ids}, 'lease_owner': WORKER_ID},
+            {'$set': {'lease_expires': datetime.now() + timedelta(seconds=LEASE_SECONDS)}})
+
+
+def lease_release(ids):
+    # Matches nothing for logs process_log already deleted
+    return {'_id': {'$in': ids}, 'lease_owner': WORKER_ID}, {'$unset': {'lease_owner': '', 'lease_expires': ''}}
+
+
+def lease_retry_delay(holder):
+    # Leased by another worker: check again once its lease could have expired
+    expires = holder.get('lease_expires', datetime.now())
+    return max(0.0, (expires - datetime.now()).total_seconds()) + 1
+
+
+def claim_log(log):
+    claimed = get_db()['survey_logs'].find_one_and_update(*lease_claim(log['_id']), return_document=ReturnDocument.AFTER)
+    if claimed is not None:
+        with held_leases_lock:
+            held_leases.add(claimed['_id'])
+    return claimed
+
+
+def release_log(log):
+    with held_leases_lock:
+        held_leases.discard(log['_id'])
+    get_db()['survey_logs'].update_one(*lease_release([log['_id']]))
+
+
+def heartbeat():
+    while True:
+        time.sleep(LEASE_SECONDS / 3)
+        with held_leases_lock:
+            ids = list(held_leases)
+        if not ids:
+            continue
+        try:
+            get_db()['survey_logs'].update_many(*lease_renewal(ids))
+        except PyMongoError as e:
+            logger.error(f"Error renewing leases: {e}")
+
+
+def start_heartbeat():
+    # One renewal thread per process, whichever entry point claims a lease first
+    shared_client('heartbeat', lambda: threading.Thread(target=heartbeat, daemon=True).start())
+
+
+def worker(log_queue):
+    while True:
+        log = log_queue.pop()
+        if stopping.is_set():
+            log_queue.done(log)
+            return
+        try:
+            claimed = claim_log(log)
+            if claimed is None:
+                holder = get_db()['survey_logs'].find_one({'_id': log['_id']}, {'lease_expires': 1})
+                if holder is not None:
+                    log_queue.retry(log, lease_retry_delay(holder))
+                continue
+            try:
+                with metrics.stage('study', study_id=str(claimed['_id'])):
+                    process_log(claimed)
+            finally:
+                release_log(claimed)
+        except Exception as e:
+            logger.error(f"An error occurred during parallel processing: {e}")
+            log_queue.retry(log, LOG_DEBOUNCE_SECONDS)
+        finally:
+            log_queue.done(log)
+
+
+def scan_logs(log_queue):
+    new_logs = 0
+    for log in get_db()['survey_logs'].find({}, {'last_update': 1, 'priority': 1}):
+        if enqueue(log_queue, log):
+            new_logs += 1
+    return new_logs
+
+
+def stream_unsupported(error):
+    """Whether polling replaces the change stream after `error`; raised again when INGEST_MODE is stream."""
+    if error.code not in CHANGE_STREAM_UNSUPPORTED:
+        logger.error(f"Change stream error: {error}")
+        return False
+    if INGEST_MODE == 'stream':
+        raise error
+    logger.warning(f"Change streams unavailable, falling back to polling: {error}")
+    return True
+
+
+def next_poll_interval(interval, new_logs):
+    # Back off while no new logs turn up
+    return POLL_MIN_INTERVAL if new_logs else min(interval * 2, POLL_MAX_INTERVAL)
+
+
+def watch_logs(log_queue):
+    resume_token = None
+    while True:
+        try:
+            with get_db()['survey_logs'].watch(LOG_EVENTS_PIPELINE, full_document='updateLookup', resume_after=resume_token) as stream:
+                if resume_token is None:
+                    # Logs written before the stream was opened
+                    scan_logs(log_queue)
+                for change in stream:
+                    resume_token = stream.resume_token
+                    log = change.get('fullDocument')
+                    if log is not None and 'last_update' in log:
+                        enqueue(log_queue, log)
+        except OperationFailure as e:
+            if stream_unsupported(e):
+                return False
+            resume_token = None
+            time.sleep(POLL_MIN_INTERVAL)
+        except PyMongoError as e:
+            logger.warning(f"Change stream interrupted: {e}")
+            time.sleep(POLL_MIN_INTERVAL)
+
+
+def poll_logs(log_queue):
+    interval = POLL_MIN_INTERVAL
+    while True:
+        try:
+            new_logs = scan_logs(log_queue)
+        except PyMongoError as e:
+            logger.error(f"Error polling survey_logs: {e}")
+            new_logs = 0
+        interval = next_poll_interval(interval, new_logs)
+        time.sleep(interval)
+
+
+def sweep_file_cache():
+    while True:
+        time.sleep(FILE_CACHE_SWEEP_SECONDS)
+        file_cache.evict()
+        # Run directories are swept on the same schedule
+        try:
+            get_staging().sweep()
+        except OSError as e:
+            logger.error(f"Error sweeping the staging area: {e}")
+
+
+def process_study(study_id):
+    """Analyse one study now, outside the daemon's queue.
+
+    A pending survey_logs entry is leased as a daemon worker would, so the
+    two never process the study at the same time, and removed once done;
+    without one the study is analysed as it stands. Returns False when
+    another worker holds the lease.
+    """
+    study_id = ObjectId(study_id)
+    if stopping.is_set():
+        raise StudyInterrupted(f"Study {study_id} not started, the process is stopping")
+    start_heartbeat()
+    log = get_db()['survey_logs'].find_one({'_id': study_id}, {'last_update': 1})
+    if log is None:
+        with metrics.stage('study', study_id=str(study_id)):
+            process_log({'_id': study_id, 'last_update': datetime.now()})
+        return True
+    claimed = claim_log(log)
+    if claimed is None:
+        return False
+    try:
+        with metrics.stage('study', study_id=str(study_id)):
+            process_log(claimed)
+    finally:
+        release_log(claimed)
+    return True
+
+
+def run_once():
+    """Process every pending survey log once, WORKERS at a time."""
+    logs = list(get_db()['survey_logs'].find({}, {'_id': 1}))
+    failed = 0
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        futures = {executor.submit(process_study, log['_id']): log['_id'] for log in logs}
         for future in as_completed(futures):
             try:
                 future.result()
             except Exception as e:
-                print(f"Error processing analysis: {e}")
-    with open("logs.txt", "a") as f:
-        f.write(f"Study {study_id} processed at {datetime.now()}\n")
-    shutil.rmtree(f"./storage/{study_id}/")
-    db['survey_logs'].delete_one({'_id': ObjectId(study_id), 'last_update': last_updated})
+                logger.error(f"Error processing study {futures[future]}: {e}")
+                failed += 1
+    return failed
+
+
+def setup_observability(serve=True):
+    """Configure logging and, if `serve`, the metrics endpoint; a busy port only costs the endpoint."""
+    metrics.configure_logging(LOG_LEVEL)
+    if serve and METRICS_PORT:
+        try:
+            metrics.start_http_server(METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Metrics endpoint unavailable on port {METRICS_PORT}: {e}")
+
+
+def handle_signals():
+    """Stop gracefully on SIGTERM and SIGINT; only possible from the main thread."""
+    if threading.current_thread() is not threading.main_thread():
+        return False
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stopping.set())
+    return True
+
+
+def close_scheduler():
+    """Once stopping, fail the prompts not sent yet so studies wind down quickly."""
+    stopping.wait()
+    scheduler = clients.get('scheduler')
+    abandoned = scheduler.close() if scheduler is not None else 0
+    logger.info("Shutting down", extra={'fields': {'abandoned_prompts': abandoned,
+                                                   'grace_seconds': SHUTDOWN_GRACE_SECONDS}})
+
+
+def drain(deadline):
+    """Wait until `deadline` for the studies in progress, then hand back the leases still held.
+
+    Returns False if some were still running.
+    """
+    while time.monotonic() < deadline:
+        with held_leases_lock:
+            if not held_leases:
+                break
+        time.sleep(0.1)
+    with held_leases_lock:
+        ids = list(held_leases)
+    if ids:
+        logger.warning(f"Releasing {len(ids)} studies still in progress after {SHUTDOWN_GRACE_SECONDS}s")
+        get_db()['survey_logs'].update_many(*lease_release(ids))
+    return not ids
+
+
+def exit_now(code):
+    """Exit without joining the pool threads of studies past the grace period.
+
+    The outputs they have written are indexed first. Their leases are
+    already handed back, so letting them run on would have this process
+    generate studies another worker may have claimed.
+    """
+    logger.warning("Abandoning the studies still in progress")
+    with open_batches_lock:
+        batches = list(open_batches)
+    for batch in batches:
+        # Outputs already written stay indexed, so resuming the study skips them
+        try:
+            batch.flush()
+        except Exception as e:
+            logger.error(f"Error indexing results of study {batch.study_id}: {e}")
+    logging.shutdown()
+    os._exit(code)
+
+
+def exit_after_grace():
+    """Hold a one-shot command to the daemon's deadline once stopping."""
+    close_scheduler()
+    time.sleep(SHUTDOWN_GRACE_SECONDS)
+    # Still running: the command did not return within the grace period
+    drain(time.monotonic())
+    file_cache.clear()
+    exit_now(1)
+
+
+def ingest(log_queue, failed):
+    try:
+        if INGEST_MODE == 'poll' or not watch_logs(log_queue):
+            poll_logs(log_queue)
+    except Exception as e:
+        logger.error(f"Ingestion stopped: {e}")
+        failed.set()
+        stopping.set()
+
 
 def main():
-    while True:
-        collection = db['survey_logs'].find()
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [executor.submit(process_log, log) for log in collection]
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"An error occurred during parallel processing: {e}")
-                    
-if __name__ == "__main__": 
-    main()
\ No newline at end of file
+    setup_observability()
+    # Broken templates stop the daemon before it claims any study
+    get_prompts()
+    handle_signals()
+    threading.Thread(target=sweep_file_cache, daemon=True).start()
+    start_heartbeat()
+    log_queue = LogQueue(LOG_DEBOUNCE_SECONDS, **QUEUE_SETTINGS)
+    metrics.gauge('study_queue_depth', 'Studies logged and waiting to be processed', log_queue.depth)
+    for _ in range(WORKERS):
+        threading.Thread(target=worker, args=(log_queue,), daemon=True).start()
+    ingest_failed = threading.Event()
+    threading.Thread(target=ingest, args=(log_queue, ingest_failed), daemon=True).start()
+    close_scheduler()
+    finished = drain(time.monotonic() + SHUTDOWN_GRACE_SECONDS)
+    # Uploads only live in this process's cache
+    file_cache.clear()
+    if not finished:
+        exit_now(1)
+    return 1 if ingest_failed.is_set() else 0
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the CR-Analyzer analyses for logged studies.")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('daemon', help="watch survey_logs and process studies as they are logged (default)")
+    commands.add_parser('async', help="watch survey_logs like daemon, on one asyncio event loop")
+    commands.add_parser('run-once', help="process the studies currently logged, then exit")
+    process = commands.add_parser('process', help="process one study now")
+    process.add_argument('study_id')
+    args = parser.parse_args(argv)
+    if args.command in (None, 'daemon'):
+        return main()
+    if args.command == 'async':
+        # motor and aioboto3 are only needed by this mode
+        import async_engine
+        return asyncio.run(async_engine.main())
+    # One-shot runs only serve metrics when a port is asked for, so they can run beside the daemon
+    setup_observability(serve='METRICS_PORT' in os.environ)
+    handle_signals()
+    threading.Thread(target=exit_after_grace, daemon=True).start()
+    try:
+        if args.command == 'run-once':
+            return 1 if run_once() else 0
+        if not process_study(args.study_id):
+            logger.error(f"Study {args.study_id} is being processed by another worker")
+            return 1
+    finally:
+        file_cache.clear()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())